@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# Batch operations on i4checklist databases without the GUI.
+#
+# usage: i4batch.py [options] add TITLE...
+#        i4batch.py [options] check TITLE...
+#        i4batch.py [options] checkout|reset|cleanup|export|validate
+#
+# The command is run on every database in the database directory, or
+# on the ones given with -f, in parallel processes. The databases are
+# rewritten atomically and only if the command changed them. A summary
+# goes to stderr; export prints the needed items of each database to
+# stdout as org.
+import errno
+import logging
+import os
+import sys
+import time
+from optparse import OptionParser
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+from i4core import NOT_NEEDED, NEED, CHECKED, CHECKOUT_STATES, \
+    RESET_STATES, ParseError, Journal, BINARY_SUFFIX, write_binary, \
+    default_db_dir, list_databases, read_database, columns, state_items, \
+    empty_items, cleanup_items
+
+COMMANDS = ("add", "check", "checkout", "reset", "cleanup", "export",
+            "validate")
+# the commands that take titles
+TITLE_COMMANDS = ("add", "check")
+
+def write_database(path, rows):
+    Journal(path).compact(rows)
+    if os.path.exists(path + BINARY_SUFFIX):
+        write_binary(path, rows)
+
+def add_items(rows, titles):
+    # the titles become needed, new items are added for the ones that
+    # aren't there
+    titles = set(titles)
+    found = set(title for state, title in rows if title in titles)
+    changed = len(titles - found)
+    result = [(NEED, title) for title in titles - found]
+    for state, title in rows:
+        if state == NOT_NEEDED and title in titles:
+            state = NEED
+            changed += 1
+        result.append((state, title))
+    return sorted(result), changed
+
+def check_items(rows, titles):
+    titles = set(titles)
+    changed = 0
+    result = []
+    for state, title in rows:
+        if state != CHECKED and title in titles:
+            state = CHECKED
+            changed += 1
+        result.append((state, title))
+    return sorted(result), changed
+
+def reset_items(rows, reset_states):
+    # what CheckListModel.cleanup() does: the empty items are removed
+    # and the items in reset_states become NOT_NEEDED
+    states, titles = columns(rows)
+    changed = len(empty_items(titles)) + \
+        len(state_items(states, reset_states - frozenset([NOT_NEEDED])))
+    states, titles = cleanup_items(states, titles, reset_states)
+    return zip(states, titles), changed
+
+def export_items(name, rows):
+    lines = ["* %s\n" % name]
+    for state, title in rows:
+        if state != NOT_NEEDED:
+            lines.append("  - [%s] %s\n" % ("X" if state == CHECKED else " ",
+                                            title.encode("utf-8")))
+    return "".join(lines)
+
+def run_command(job):
+    # Runs the command on one database; this is what the worker
+    # processes do. Returns (name, error, changed, output).
+    path, command, titles, dry_run = job
+    name = os.path.basename(path)
+    try:
+        if not os.path.exists(path):
+            # read_database() would take it for an empty database
+            raise IOError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        rows = read_database(path)
+        changed, output = 0, None
+        if command == "add":
+            rows, changed = add_items(rows, titles)
+        elif command == "check":
+            rows, changed = check_items(rows, titles)
+        elif command == "checkout":
+            rows, changed = reset_items(rows, CHECKOUT_STATES)
+        elif command == "reset":
+            rows, changed = reset_items(rows, RESET_STATES)
+        elif command == "cleanup":
+            rows, changed = reset_items(rows, frozenset())
+        elif command == "export":
+            output = export_items(name, rows)
+        if changed and not dry_run:
+            write_database(path, rows)
+    except (ParseError, ValueError, EnvironmentError), e:
+        return name, str(e), 0, None
+    return name, None, changed, output
+
+def run_jobs(jobs, processes):
+    if multiprocessing is None or processes == 1 or len(jobs) < 2:
+        return map(run_command, jobs)
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(run_command, jobs,
+                        max(1, len(jobs) // (4 * processes)))
+    finally:
+        pool.close()
+        pool.join()
+
+def main(argv=None):
+    logging.basicConfig()
+    parser = OptionParser(
+        usage="%prog [options] COMMAND [TITLE...]\n\ncommands: " +
+        ", ".join(COMMANDS))
+    parser.add_option("-d", "--dir", default=default_db_dir(),
+                      help="database directory [%default]")
+    parser.add_option("-f", "--file", action="append", dest="files",
+                      metavar="DB", help="database to process; may be "
+                      "repeated, all the databases by default")
+    parser.add_option("-j", "--jobs", type="int", default=0,
+                      help="number of processes [number of CPUs]")
+    parser.add_option("-n", "--dry-run", action="store_true",
+                      default=False, help="don't write the databases")
+    parser.add_option("-q", "--quiet", action="store_true", default=False,
+                      help="only report errors and the summary")
+    options, args = parser.parse_args(argv)
+    if not args or args[0] not in COMMANDS:
+        parser.error("expected one of the commands: " + ", ".join(COMMANDS))
+    command = args[0]
+    titles = [arg.decode("utf-8").strip() for arg in args[1:]]
+    titles = [title for title in titles if title]
+    if (command in TITLE_COMMANDS) != bool(titles):
+        parser.error("add and check take titles, other commands don't")
+    names = options.files or list_databases(options.dir)
+    jobs = [(os.path.join(options.dir, name), command, titles,
+             options.dry_run) for name in names]
+    processes = options.jobs
+    if not processes:
+        processes = multiprocessing and multiprocessing.cpu_count() or 1
+
+    start = time.time()
+    results = run_jobs(jobs, processes)
+    errors = changed_dbs = changed_items = 0
+    for name, error, changed, output in results:
+        if output is not None:
+            sys.stdout.write(output)
+        if error is not None:
+            errors += 1
+            print >>sys.stderr, "%s: error: %s" % (name, error)
+        elif changed:
+            changed_dbs += 1
+            changed_items += changed
+            if not options.quiet:
+                print >>sys.stderr, "%s: %d changed" % (name, changed)
+    print >>sys.stderr, \
+        "%s: %d databases, %d changed (%d items), %d errors, %.2f s%s" % (
+        command, len(results), changed_dbs, changed_items, errors,
+        time.time() - start, " (dry run)" if options.dry_run else "")
+    return 1 if errors else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
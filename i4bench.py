@@ -0,0 +1,497 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Benchmarks for i4checklist.
+#
+# usage: i4bench.py [N_ITEMS]
+#        i4bench.py checkout [N_ITEMS]
+#        i4bench.py startup
+#        i4bench.py memory legacy|native N_ITEMS
+#        i4bench.py suite [-o RESULTS.json] [N_ITEMS...]
+#        i4bench.py compare OLD.json NEW.json [MAX_RATIO]
+#
+# The suite prints its results as JSON so that runs can be compared
+# with the compare command, which exits with status 1 if anything got
+# slower than MAX_RATIO times the old result. With I4CHECKLIST_PROFILE
+# set, the suite also prints the profile of the run (see i4core.Profile)
+# to stderr; the profiling adds to the timings.
+from __future__ import with_statement
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from StringIO import StringIO
+from timeit import default_timer as clock
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+BENCH_SIZES = (1000, 10000, 50000)
+N_TOGGLES = 200
+CHECKOUT_SIZE = 50000
+STARTUP_RUNS = 7
+SUITE_SIZES = (1000, 10000, 100000)
+SUITE_REPEAT = 5
+SUITE_SEED = 42
+PAINT_ROWS = 200
+PAINT_WIDTH = 800
+SCREEN_ROWS = 8
+SCROLL_ROWS = 100
+SCROLL_FRAMES = 300
+MAX_RATIO = 1.2
+# what typing "milk" and then "ねぎ" looks like
+SEARCH_QUERIES = (u"m", u"mi", u"mil", u"milk", u"milk ね", u"milk ねぎ",
+                  u"milk bread")
+# the titles are "item NNNNNN ..."
+HISTORY_QUERIES = (u"i", u"item 0", u"item 00", u"item 001", u"item 0012")
+
+WORDS = (u"товар", u"молоко", u"хлеб", u"Äpfel", u"crème fraîche",
+         u"jalapeño", u"pâte brisée", u"żubrówka", u"овсяные хлопья",
+         u"醤油", u"ねぎ", u"豆腐", u"λεμόνια", u"ψωμί", u"bread", u"milk",
+         u"washing powder", u"AA batteries")
+
+def make_items(n, seed=SUITE_SEED):
+    # mixed states and long titles with non-ASCII characters; the same
+    # seed always gives the same items
+    rnd = random.Random(seed)
+    return [(rnd.choice((0, 0, 0, 1, 2)),
+             u"item %06d %s" % (
+                 i, u" ".join(rnd.choice(WORDS)
+                              for k in xrange(rnd.randint(1, 8)))))
+            for i in xrange(n)]
+
+def setup_env():
+    # keep the databases and QSettings away from the real ones
+    home = tempfile.mkdtemp(prefix="i4bench")
+    os.environ["HOME"] = home
+    os.makedirs(os.path.join(home, "MyDocs", ".i4checklist"))
+    return home
+
+def write_db(home, items, name="default", presorted=True):
+    from i4core import serialize_data
+    path = os.path.join(home, "MyDocs", ".i4checklist", name)
+    with open(path, "wt") as f:
+        serialize_data(sorted(items) if presorted else items, f)
+    return path
+
+def rss_bytes():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+def make_legacy_model(items):
+    # the QSortFilterProxyModel over QStandardItemModel stack
+    # CheckListModel used to be
+    from PyQt4.QtCore import Qt, QRegExp
+    from PyQt4.QtGui import QStandardItemModel, QStandardItem, \
+        QSortFilterProxyModel
+
+    class LegacyModel(QSortFilterProxyModel):
+        def lessThan(self, left, right):
+            if super(LegacyModel, self).lessThan(left, right):
+                return True
+            if super(LegacyModel, self).lessThan(right, left):
+                return False
+            return unicode(left.data().toPyObject()) < \
+                unicode(right.data().toPyObject())
+
+        def cleanup(self, check_values=None):
+            model = self.sourceModel()
+            i = 0
+            while i < model.rowCount():
+                index = model.index(i, 0)
+                value = index.data().toPyObject()
+                value = value and unicode(value).strip()
+                if not value:
+                    model.removeRow(i)
+                    continue
+                check_value = int(index.data(Qt.CheckStateRole).toPyObject())
+                if check_values and check_value in check_values:
+                    model.setData(index, Qt.Unchecked, Qt.CheckStateRole)
+                i += 1
+
+        def checkout(self):
+            self.cleanup((Qt.Checked,))
+
+        def set_show_all(self, show_all):
+            if show_all:
+                self.setFilterRegExp("")
+            else:
+                self.setFilterRegExp(
+                    QRegExp("^%d|%d$" % (Qt.Checked, Qt.PartiallyChecked)))
+
+    check_states = (Qt.Unchecked, Qt.PartiallyChecked, Qt.Checked)
+    model = LegacyModel()
+    source = QStandardItemModel(0, 1, model)
+    model.setFilterRole(Qt.CheckStateRole)
+    model.setSortRole(Qt.CheckStateRole)
+    model.setDynamicSortFilter(True)
+    model.setSourceModel(source)
+    for state, title in items:
+        item = QStandardItem(title)
+        item.setFlags(
+            Qt.ItemIsUserCheckable | Qt.ItemIsTristate | Qt.ItemIsEnabled |
+            Qt.ItemIsEditable)
+        item.setData(check_states[state], Qt.CheckStateRole)
+        source.appendRow([item])
+    model.sort(0, Qt.AscendingOrder)
+    return model
+
+def make_native_model(home, items):
+    from i4checklist import CheckListModel
+    write_db(home, items)
+    return CheckListModel()
+
+def make_model(kind, home, items):
+    if kind == "legacy":
+        return make_legacy_model(items)
+    return make_native_model(home, items)
+
+def bench_toggle(model, n_toggles=N_TOGGLES):
+    from PyQt4.QtCore import Qt, QVariant
+    rnd = random.Random(1)
+    check_states = (Qt.Unchecked, Qt.PartiallyChecked, Qt.Checked)
+    start = time.time()
+    for i in xrange(n_toggles):
+        index = model.index(rnd.randrange(model.rowCount()), 0)
+        model.setData(index, QVariant(rnd.choice(check_states)),
+                      Qt.CheckStateRole)
+    return (time.time() - start) / n_toggles
+
+def bench_checkout(model):
+    start = time.time()
+    model.checkout()
+    return time.time() - start
+
+def run_checkout(n):
+    from PyQt4.QtGui import QApplication
+    home = setup_env()
+    app = QApplication(sys.argv)
+    # make sure there's plenty to check out
+    items = [(state or 2, title) for state, title in make_items(n)]
+    print "%-8s %8s %6s %14s" % ("model", "items", "view", "checkout, s")
+    for kind in ("legacy", "native"):
+        for show_all in (True, False):
+            model = make_model(kind, home, items)
+            model.set_show_all(show_all)
+            print "%-8s %8d %6s %14.3f" % (
+                kind, n, "all" if show_all else "need",
+                bench_checkout(model))
+
+def time_import(module):
+    # median wall time of starting python and importing module
+    # in a fresh process, or None if the import fails
+    times = []
+    with open(os.devnull, "w") as devnull:
+        for i in xrange(STARTUP_RUNS):
+            start = time.time()
+            status = subprocess.call(
+                [sys.executable, "-c", "import %s" % module],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=devnull)
+            if status != 0:
+                return None
+            times.append(time.time() - start)
+    return sorted(times)[len(times) // 2]
+
+def run_startup():
+    # Only the imports are timed, not the cold start up to the first
+    # window shown, which has to be timed on the device. No before and
+    # after numbers for it were taken when the Qt-free i4core was split
+    # out.
+    base = time_import("sys")
+    print "%-14s %10s" % ("import", "ms")
+    print "%-14s %10.1f" % ("(interpreter)", base * 1000)
+    for module in ("i4core", "PyQt4.QtGui", "i4checklist"):
+        elapsed = time_import(module)
+        if elapsed is None:
+            print "%-14s %10s" % (module, "failed")
+        else:
+            print "%-14s %10.1f" % (module, (elapsed - base) * 1000)
+
+def run_memory(kind, n):
+    from PyQt4.QtGui import QApplication
+    home = setup_env()
+    app = QApplication(sys.argv)
+    items = make_items(n)
+    before = rss_bytes()
+    model = make_model(kind, home, items)
+    return (rss_bytes() - before) / float(n)
+
+def measure_memory(kind, n):
+    # each model is measured in a fresh process so that memory freed
+    # by the previous one doesn't skew the numbers
+    out = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "memory", kind, str(n)],
+        stdout=subprocess.PIPE).communicate()[0]
+    return float(out.strip().splitlines()[-1])
+
+def best_time(func, repeat=SUITE_REPEAT, setup=None):
+    # the best of repeat runs; setup is called before each run and
+    # isn't timed
+    best = None
+    for i in xrange(repeat):
+        if setup is not None:
+            setup()
+        start = clock()
+        func()
+        elapsed = clock() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def suite_core(items, repeat):
+    from i4core import parse_data, serialize_data, columns, TitleIndex, \
+        TitleHistory, filter_items, scan_titles
+    out = StringIO()
+    serialize_data(items, out)
+    text = out.getvalue()
+    titles = [title for state, title in items]
+    index = TitleIndex(titles)
+    states, sorted_titles = columns(sorted(items))
+    def search(query):
+        # what a keystroke in the search field costs
+        return filter_items(states, sorted_titles, index.search(query))
+    keys = {}
+    def scan(query):
+        # the same while the index is being built
+        return scan_titles(sorted_titles, query, keys)
+    history = TitleHistory(tempfile.mkdtemp(prefix="i4bench"))
+    history.use(titles)
+    # items used more than once
+    history.use(titles[::7])
+    history.flush()
+    history.suggest(u"i")
+    return {
+        "parse_data": best_time(
+            lambda: list(parse_data(StringIO(text))), repeat),
+        "serialize_data": best_time(
+            lambda: serialize_data(items, StringIO()), repeat),
+        "title_index": best_time(lambda: TitleIndex(titles), repeat),
+        "search": best_time(
+            lambda: [search(query) for query in SEARCH_QUERIES],
+            repeat) / len(SEARCH_QUERIES),
+        "search_scan": best_time(
+            lambda: [scan(query) for query in SEARCH_QUERIES],
+            repeat) / len(SEARCH_QUERIES),
+        "suggest": best_time(
+            lambda: [history.suggest(query) for query in HISTORY_QUERIES],
+            repeat) / len(HISTORY_QUERIES)}
+
+def view_option(rect):
+    from PyQt4.QtGui import QStyle, QStyleOptionViewItemV4
+    option = QStyleOptionViewItemV4()
+    option.rect = rect
+    option.state = QStyle.State_Enabled
+    return option
+
+def bench_paint(model, rows=PAINT_ROWS):
+    # renders rows spread over the whole list into an offscreen image;
+    # returns the time per row
+    from PyQt4.QtCore import QRect
+    from PyQt4.QtGui import QImage, QPainter
+    from i4checklist import CheckBoxDelegate, ITEM_HEIGHT
+    delegate = CheckBoxDelegate()
+    image = QImage(PAINT_WIDTH, ITEM_HEIGHT,
+                   QImage.Format_ARGB32_Premultiplied)
+    painter = QPainter(image)
+    step = max(1, model.rowCount() // rows)
+    try:
+        start = clock()
+        for k in xrange(rows):
+            delegate.paint(painter,
+                           view_option(QRect(0, 0, PAINT_WIDTH, ITEM_HEIGHT)),
+                           model.index(k * step % model.rowCount(), 0))
+        return (clock() - start) / rows
+    finally:
+        painter.end()
+
+def bench_scroll(model, cache_size):
+    # flicks through the first SCROLL_ROWS rows and back, painting a
+    # screenful of rows per frame like the view does; returns the mean
+    # frame time
+    from PyQt4.QtCore import QRect
+    from PyQt4.QtGui import QImage, QPainter
+    from i4checklist import CheckBoxDelegate, ITEM_HEIGHT
+    delegate = CheckBoxDelegate(cache_size=cache_size)
+    image = QImage(PAINT_WIDTH, SCREEN_ROWS * ITEM_HEIGHT,
+                   QImage.Format_ARGB32_Premultiplied)
+    painter = QPainter(image)
+    n = model.rowCount()
+    span = max(1, min(n, SCROLL_ROWS) - SCREEN_ROWS)
+    try:
+        start = clock()
+        for frame in xrange(SCROLL_FRAMES):
+            first = frame % (2 * span)
+            if first > span:
+                first = 2 * span - first
+            for k in xrange(min(SCREEN_ROWS, n - first)):
+                delegate.paint(
+                    painter, view_option(QRect(0, k * ITEM_HEIGHT,
+                                               PAINT_WIDTH, ITEM_HEIGHT)),
+                    model.index(first + k, 0))
+        return (clock() - start) / SCROLL_FRAMES
+    finally:
+        painter.end()
+
+def suite_model(home, items, repeat):
+    from PyQt4.QtCore import Qt, QVariant
+    from i4core import write_binary
+    from i4checklist import CheckListModel, PAINT_CACHE_SIZE
+    path = write_db(home, items)
+    shuffled = list(items)
+    random.Random(SUITE_SEED).shuffle(shuffled)
+    write_db(home, shuffled, "unsorted", False)
+    model = CheckListModel()
+    # switching databases must not be served from the cache
+    model.cache.budget = 0
+    model.load("default")
+    def toggle():
+        index = model.index(0, 0)
+        state = index.data(Qt.CheckStateRole).toPyObject()
+        model.setData(
+            index, QVariant(Qt.Checked if state != Qt.Checked
+                            else Qt.PartiallyChecked), Qt.CheckStateRole)
+    def save(compact):
+        model.save(compact)
+        model.flush()
+    def show_all():
+        model.set_show_all(False)
+        model.set_show_all(True)
+    def first_rows():
+        # a background load until its first chunk is shown
+        model.load("default")
+        while not model.rowCount():
+            time.sleep(0.0002)
+            model._load_chunks()
+    results = {
+        "load": best_time(model.load, repeat),
+        "load_binary": best_time(model.load, repeat, lambda: write_binary(
+            path, sorted(items))),
+        # the rows are kept sorted, so sorting is what load does with
+        # an unsorted file and what setData does to move a changed row
+        "load_unsorted": best_time(lambda: model.load("unsorted"), repeat),
+        "toggle": bench_toggle(model),
+        "set_show_all": best_time(show_all, repeat),
+        "paint_row": bench_paint(model),
+        "scroll_frame": bench_scroll(model, PAINT_CACHE_SIZE),
+        "scroll_frame_uncached": bench_scroll(model, 0),
+        "save": best_time(lambda: save(True), repeat, toggle),
+        "save_journal": best_time(lambda: save(False), repeat, toggle)}
+    model.background, model.writer.binary = True, False
+    results["load_first_rows"] = best_time(first_rows, repeat,
+                                           model.finish_loading)
+    model.finish_loading()
+    model.background, model.writer.binary = False, True
+    model.load("default")
+    results["checkout"] = best_time(model.checkout, repeat, model.load)
+    results["reset_items"] = best_time(model.reset_items, repeat, model.load)
+    model.flush()
+    return results
+
+def run_suite(sizes, repeat=SUITE_REPEAT):
+    meta = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "sizes": list(sizes),
+        "repeat": repeat,
+        "seed": SUITE_SEED}
+    try:
+        # Qt 5 and later can render without a display
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+        from PyQt4.QtCore import QT_VERSION_STR
+        from PyQt4.QtGui import QApplication
+    except ImportError:
+        print >>sys.stderr, "PyQt4 not available, skipping the model"
+        app = None
+    else:
+        meta["qt"] = QT_VERSION_STR
+        home = setup_env()
+        app = QApplication(sys.argv)
+    results = {}
+    for n in sizes:
+        items = make_items(n)
+        timings = suite_core(items, repeat)
+        if app is not None:
+            timings.update(suite_model(home, items, repeat))
+        for name, seconds in timings.iteritems():
+            results.setdefault(name, {})[str(n)] = seconds
+        print >>sys.stderr, "%d items done" % n
+    from i4core import profile
+    if profile.enabled:
+        sys.stderr.write(profile.report())
+    return {"meta": meta, "results": results}
+
+def compare_results(old, new, max_ratio=MAX_RATIO):
+    # prints the new/old time ratios; returns the number of
+    # regressions, i.e. ratios above max_ratio
+    regressions = 0
+    print "%-16s %8s %12s %12s %8s" % ("benchmark", "items", "old, ms",
+                                       "new, ms", "ratio")
+    for name in sorted(new["results"]):
+        old_timings = old["results"].get(name, {})
+        for n, seconds in sorted(new["results"][name].iteritems(),
+                                 key=lambda (n, seconds): int(n)):
+            if not old_timings.get(n):
+                continue
+            ratio = seconds / old_timings[n]
+            mark = ""
+            if ratio > max_ratio:
+                regressions += 1
+                mark = " !"
+            print "%-16s %8s %12.3f %12.3f %8.2f%s" % (
+                name, n, old_timings[n] * 1000, seconds * 1000, ratio, mark)
+    return regressions
+
+def main(argv):
+    if len(argv) > 1 and argv[1] == "suite":
+        args = argv[2:]
+        output = None
+        if args[:1] == ["-o"]:
+            output, args = args[1], args[2:]
+        report = run_suite([int(n) for n in args] or SUITE_SIZES)
+        if output is None:
+            json.dump(report, sys.stdout, indent=2, sort_keys=True,
+                      separators=(",", ": "))
+            print
+        else:
+            with open(output, "w") as f:
+                json.dump(report, f, indent=2, sort_keys=True,
+                          separators=(",", ": "))
+        return
+    if len(argv) in (4, 5) and argv[1] == "compare":
+        with open(argv[2]) as f:
+            old = json.load(f)
+        with open(argv[3]) as f:
+            new = json.load(f)
+        max_ratio = float(argv[4]) if len(argv) > 4 else MAX_RATIO
+        if compare_results(old, new, max_ratio):
+            sys.exit(1)
+        return
+    if len(argv) == 4 and argv[1] == "memory":
+        print run_memory(argv[2], int(argv[3]))
+        return
+    if len(argv) > 1 and argv[1] == "startup":
+        run_startup()
+        return
+    if len(argv) > 1 and argv[1] == "checkout":
+        run_checkout(int(argv[2]) if len(argv) > 2 else CHECKOUT_SIZE)
+        return
+    from PyQt4.QtGui import QApplication
+    sizes = [int(argv[1])] if len(argv) > 1 else BENCH_SIZES
+    home = setup_env()
+    app = QApplication(sys.argv)
+    print "%-8s %8s %14s %14s" % ("model", "items", "bytes/row", "toggle, ms")
+    for n in sizes:
+        items = make_items(n)
+        for kind in ("legacy", "native"):
+            model = make_model(kind, home, items)
+            toggle = bench_toggle(model)
+            print "%-8s %8d %14.1f %14.3f" % (
+                kind, n, measure_memory(kind, n), toggle * 1000)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -1,102 +1,181 @@
 #!/usr/bin/env python
 from __future__ import with_statement
+import bisect
 import logging
+import time
 import re
 import sys
 import os.path
+from array import array
+from itertools import izip
 #from PySide import QtCore, QtGui #, QtMaemo5
-from PyQt4.QtCore import Qt, QRect, QTimer, QRegExp, QSettings, SIGNAL
+from PyQt4.QtCore import Qt, QRect, QSize, QTimer, QSettings, SIGNAL, \
+    QAbstractListModel, QModelIndex, QVariant, QEvent, QFileSystemWatcher
 from PyQt4.QtGui import QApplication, QStyledItemDelegate, QPalette, \
-    QStyle, QStyleOptionButton, QPen, QWidget, QStandardItemModel, \
-    QStandardItem, QTableView, QAbstractItemView, QPushButton, \
-    QVBoxLayout, QHBoxLayout, QRadioButton, QSortFilterProxyModel, \
-    QFont, QHeaderView, QMessageBox, QComboBox, QLabel, QInputDialog, \
-    QMainWindow, QAction
+    QStyle, QStyleOptionButton, QPen, QWidget, QTableView, QListView, \
+    QAbstractItemView, QPushButton, QVBoxLayout, QHBoxLayout, \
+    QRadioButton, QFont, QHeaderView, QMessageBox, QComboBox, QLabel, \
+    QInputDialog, QMainWindow, QAction, QLineEdit, QPixmap, QPainter, \
+    QDialog, QCompleter, QStringListModel
+from i4core import NOT_NEEDED, NEED, CHECKED, DB_CACHE_BUDGET, \
+    JOURNAL_SUFFIX, JOURNAL_COMPACT_SIZE, ParseError, parse_data, \
+    default_db_dir, list_databases, Journal, DatabaseCache, DatabaseWriter, \
+    read_columns, count_states, columns, find_position, state_items, \
+    empty_items, change_states, IndexBuilder, search_words, scan_titles, \
+    filter_items, BINARY_SUFFIX, open_binary, file_signature, \
+    database_signature, replay_journal, diff_items, profile, NeedSummaries, \
+    TitleHistory, DatabaseReader
 
 log = logging.getLogger(__name__)
 
-SAMPLE_DATA = """* ALL
-  - [ ] item one
-  - [ ] item two
-  - [ ] item three
-  - [ ] item four
-** NEED
-   - [ ] item five
-   - [X] item six
-   - [X] item seven
-"""
-
-class ParseError(Exception):
-    pass
-
-def parse_check_line(line):
-    m = re.match(r"\s*-\s*\[(.)\]\s*(.*?)\s*$", line)
-    if not m:
-        raise ParseError("expected check line, got %r" % line)
-    return bool(m.group(1).strip()), m.group(2).decode("utf-8")
-
-NOT_NEEDED = 0
-NEED = 1
-CHECKED = 2
-
 CHECK_FIELD_WIDTH = 60
 ITEM_HEIGHT = 60
 BULLET_SIZE = 12
 SAVE_INTERVAL_MS = 3000
+# how long to wait for more changes to the databases by other programs
+# before looking at them, and how often to look when they can't be
+# watched
+WATCH_DELAY_MS = 300
+POLL_INTERVAL_MS = 2000
+# how often the chunks of a database loaded in the background are
+# shown, see CheckListModel.load()
+LOAD_INTERVAL_MS = 20
+PAINT_CACHE_SIZE = 1024
+# where the profile is saved when profiling is enabled, see
+# i4core.Profile
+PROFILE_FILE = "~/MyDocs/i4checklist-profile.txt"
 
-def parse_data(s):
-    state = "notstarted"
-    for line in s.readlines():
-        if not line.strip():
-            continue
-        if state == "notstarted":
-            if not re.match(r"\*\s*ALL", line):
-                raise ParseError("expected * ALL, got %r" % line)
-            state = "not_needed"
-        elif state == "not_needed":
-            if re.match(r"\*\*\s*NEED", line):
-                state = "need"
-                continue
-            checked, title = parse_check_line(line)
-            yield NOT_NEEDED, title
-        elif state == "need":
-            checked, title = parse_check_line(line)
-            if checked:
-                yield CHECKED, title
-            else:
-                yield NEED, title
+def strike_out_font(font):
+    font = QFont(font)
+    font.setStrikeOut(True)
+    return font
 
-def serialize_data(data, out):
-    print >>out, "* ALL"
-    for state, title in data:
-        if state == NOT_NEEDED:
-            print >>out, "  - [ ] %s" % title.encode("utf-8")
-    print >>out, "** NEED"
-    for state, title in data:
-        if state == NOT_NEEDED:
-            continue
-        print >>out, "   - [%s] %s" % \
-            ("X" if state == CHECKED else " ", title.encode("utf-8"))
-
-def test_it():
-    from cStringIO import StringIO
-    parsed = list(parse_data(StringIO(SAMPLE_DATA)))
-    print "PARSED:\n%r\n" % parsed
-    out = StringIO()
-    serialize_data(parsed, out)
-    serialized = out.getvalue()
-    print "SERIALIZED:\n%s---" % serialized
-    assert SAMPLE_DATA == serialized
+class TitleCompleter(QCompleter):
+    # Completes the title being typed in editor with the titles used
+    # most often and most lately, see TitleHistory.suggest(). The
+    # suggestions are ranked already, so the popup shows them as they
+    # are.
+    def __init__(self, history, editor):
+        super(TitleCompleter, self).__init__(editor)
+        self.history = history
+        self.setModel(QStringListModel(self))
+        self.setCompletionMode(QCompleter.UnfilteredPopupCompletion)
+        editor.setCompleter(self)
+        self.connect(editor, SIGNAL("textEdited(QString)"), self.suggest)
+
+    def suggest(self, text):
+        titles = self.history.suggest(unicode(text))
+        self.model().setStringList(titles)
+        if titles:
+            self.complete()
+        else:
+            self.popup().hide()
 
 class CheckBoxDelegate(QStyledItemDelegate):
+    # Everything paint() computes besides the option itself is cached:
+    # the item geometry, the elided titles, the struck-out fonts and
+    # the check indicator pixmaps. The keys include what the values
+    # depend on, the cache is emptied when it grows past cache_size
+    # entries and the view calls clear_cache() when its style, palette
+    # or font change.
+    def __init__(self, parent=None, cache_size=PAINT_CACHE_SIZE,
+                 item_height=None, history=None):
+        super(CheckBoxDelegate, self).__init__(parent)
+        self.cache_size = cache_size
+        # if set, all the items are this high
+        self.item_height = item_height
+        # if set, the TitleHistory completing the edited titles
+        self.history = history
+        self._cache = {}
+
+    def clear_cache(self):
+        self._cache.clear()
+
+    def _cached(self, key, make, *args):
+        value = self._cache.get(key)
+        if value is None:
+            if profile.enabled:
+                profile.count("paint_miss")
+            if len(self._cache) >= self.cache_size:
+                self._cache.clear()
+            value = self._cache[key] = make(*args)
+        return value
+
     def createEditor(self, parent, option, index):
         editor = super(CheckBoxDelegate, self). \
             createEditor(parent, option, index)
         if editor is not None:
             editor.setInputMethodHints(Qt.ImhNoAutoUppercase)
+            if self.history is not None and isinstance(editor, QLineEdit):
+                TitleCompleter(self.history, editor)
         return editor
 
+    def sizeHint(self, option, index):
+        if self.item_height is not None:
+            # the items are as wide as the view and the titles are
+            # elided, so there's no text to lay out
+            return QSize(1, self.item_height)
+        return super(CheckBoxDelegate, self).sizeHint(option, index)
+
+    def _item_rects(self, style, option, widget):
+        # text and check indicator rects for an item at (0, 0)
+        rect = QRect(option.rect)
+        option.rect = QRect(0, 0, rect.width(), rect.height())
+        try:
+            return (style.subElementRect(
+                        QStyle.SE_ItemViewItemText, option, widget),
+                    style.subElementRect(
+                        QStyle.SE_ItemViewItemCheckIndicator, option, widget))
+        finally:
+            option.rect = rect
+
+    def _bullet_pixmap(self, size, palette):
+        pixmap = QPixmap(size)
+        pixmap.fill(Qt.transparent)
+        painter = QPainter(pixmap)
+        try:
+            painter.fillRect(pixmap.rect(), palette.brush(QPalette.Base))
+            bullet_rect = pixmap.rect()
+            if bullet_rect.width() > BULLET_SIZE:
+                bullet_rect.setLeft(
+                    bullet_rect.left() +
+                    (bullet_rect.width() - BULLET_SIZE) / 2)
+                bullet_rect.setWidth(BULLET_SIZE)
+            if bullet_rect.height() > BULLET_SIZE:
+                bullet_rect.setTop(
+                    bullet_rect.top() +
+                    (bullet_rect.height() - BULLET_SIZE) / 2)
+                bullet_rect.setHeight(BULLET_SIZE)
+            painter.setPen(QPen(palette.color(QPalette.Text)))
+            painter.setBrush(palette.brush(QPalette.Text))
+            painter.drawEllipse(bullet_rect)
+        finally:
+            painter.end()
+        return pixmap
+
+    def _check_pixmap(self, size, state, style, option, widget):
+        pixmap = QPixmap(size)
+        pixmap.fill(Qt.transparent)
+        painter = QPainter(pixmap)
+        try:
+            check_opt = QStyleOptionButton()
+            check_opt.rect = pixmap.rect()
+            check_opt.state = state
+            check_opt.palette = option.palette
+            check_opt.direction = option.direction
+            style.drawPrimitive(
+                QStyle.PE_IndicatorItemViewItemCheck, check_opt, painter,
+                widget)
+        finally:
+            painter.end()
+        return pixmap
+
+    @profile.timed("paint")
     def paint(self, painter, option, index):
+        if not index.flags() & Qt.ItemIsUserCheckable:
+            # the database headings of NeedListModel
+            QStyledItemDelegate.paint(self, painter, option, index)
+            return
         self.initStyleOption(option, index)
         if hasattr(option, "checkState"):
             if option.checkState == Qt.Unchecked:
@@ -104,8 +183,9 @@ class CheckBoxDelegate(QStyledItemDelegate):
             elif option.checkState == Qt.PartiallyChecked:
                 option.checkState = Qt.Unchecked
             elif option.checkState == Qt.Checked:
-                option.font = QFont(option.font)
-                option.font.setStrikeOut(True)
+                option.font = self._cached(
+                    ("font", option.font.key()), strike_out_font,
+                    option.font)
         # ref: qt4-x11-4.6.2/src/gui/styles/qcommonstyle.cpp
         painter.save()
         painter.setClipRect(option.rect)
@@ -114,95 +194,421 @@ class CheckBoxDelegate(QStyledItemDelegate):
         #     getattr(option, "widget", None))
         style = QApplication.style()
         widget = getattr(option, "widget", None)
-        # log.debug("widget: %r style: %r" % (widget, style.metaObject().className()))
+        # log.debug("widget: %r style: %r", widget,
+        #           style.metaObject().className())
         style.drawPrimitive(
             QStyle.PE_PanelItemViewItem, option, painter, widget)
 
         if option.checkState == Qt.Checked:
             painter.setOpacity(0.3)
-        text_rect = style.subElementRect(
-            QStyle.SE_ItemViewItemText, option, widget)
-        item_text = option.fontMetrics.elidedText(
-            option.text, option.textElideMode, text_rect.width())
+        font_key = option.font.key()
+        text_rect, check_rect = self._cached(
+            ("rects", option.rect.width(), option.rect.height(), font_key,
+             int(option.features), int(option.direction), id(style)),
+            self._item_rects, style, option, widget)
+        text_rect = text_rect.translated(option.rect.topLeft())
+        text = unicode(option.text)
+        item_text = self._cached(
+            ("text", text, text_rect.width(), font_key,
+             int(option.textElideMode)),
+            option.fontMetrics.elidedText, text, option.textElideMode,
+            text_rect.width())
         painter.setFont(option.font)
         style.drawItemText(painter, text_rect, option.displayAlignment,
                            option.palette, True, item_text, QPalette.Text)
 
-        check_rect = style.subElementRect(
-            QStyle.SE_ItemViewItemCheckIndicator, option, widget)
         if option.checkState == Qt.PartiallyChecked:
-            brush = option.palette.brush(QPalette.Base)
-            painter.fillRect(check_rect, brush)
-            bullet_rect = QRect(check_rect)
-            if bullet_rect.width() > BULLET_SIZE:
-                bullet_rect.setLeft(
-                    bullet_rect.left() +
-                    (bullet_rect.width() - BULLET_SIZE) / 2)
-                bullet_rect.setWidth(BULLET_SIZE)
-            if bullet_rect.height() > BULLET_SIZE:
-                bullet_rect.setTop(
-                    bullet_rect.top() +
-                    (bullet_rect.height() - BULLET_SIZE) / 2)
-                bullet_rect.setHeight(BULLET_SIZE)
-            painter.setPen(QPen(option.palette.color(QPalette.Text)))
-            painter.setBrush(option.palette.brush(QPalette.Text))
-            painter.drawEllipse(bullet_rect)
+            pixmap = self._cached(
+                ("bullet", check_rect.width(), check_rect.height(),
+                 option.palette.cacheKey()),
+                self._bullet_pixmap, check_rect.size(), option.palette)
         else:
-            check_opt = QStyleOptionButton()
-            check_opt.rect = check_rect
-            check_opt.state = option.state & ~QStyle.State_HasFocus
+            state = option.state & ~QStyle.State_HasFocus
             if option.checkState == Qt.Checked:
-                check_opt.state |= QStyle.State_On
+                state |= QStyle.State_On
             else:
-                check_opt.state |= QStyle.State_Off
-            style.drawPrimitive(
-                QStyle.PE_IndicatorItemViewItemCheck, check_opt, painter,
+                state |= QStyle.State_Off
+            pixmap = self._cached(
+                ("check", check_rect.width(), check_rect.height(),
+                 int(state), option.palette.cacheKey(),
+                 int(option.direction), id(style)),
+                self._check_pixmap, check_rect.size(), state, style, option,
                 widget)
+        painter.drawPixmap(check_rect.topLeft() + option.rect.topLeft(),
+                           pixmap)
         painter.restore()
 
-class CheckListModel(QSortFilterProxyModel):
-    # FIXME: should not use the proxy. just implement the real model
-    def __init__(self, parent=None):
+ITEM_FLAGS = Qt.ItemIsUserCheckable | Qt.ItemIsTristate | \
+    Qt.ItemIsEnabled | Qt.ItemIsEditable
+
+class CheckListModel(QAbstractListModel):
+    # The rows are kept in two parallel arrays sorted by (state, title):
+    # a byte array of states and a list of unicode titles. The Need
+    # view hides the NOT_NEEDED items, which always come first, so view
+    # row r is item r + _hidden. While a search is active, _matches is
+    # the sorted list of the shown items instead.
+    def __init__(self, parent=None, background=False):
         super(CheckListModel, self).__init__(parent)
         self.settings = QSettings("fionbio", "i4checklist")
+        # whether to parse the databases in the background, see load()
+        self.background = background
+        self._reader = None
+        self.load_timer = QTimer()
+        self.load_timer.setInterval(LOAD_INTERVAL_MS)
+        self.connect(self.load_timer, SIGNAL("timeout()"), self._load_chunks)
         self._updatePending = False
-        model = QStandardItemModel(0, 1, self)
-        self.setFilterRole(Qt.CheckStateRole)
-        self.setSortRole(Qt.CheckStateRole)
-        self.setDynamicSortFilter(True)
-        self.setSourceModel(model)
-        # setting filter regexp to non-empty pattern
-        # causes the proxy to fail to sort its items
-        self.set_show_all(True)
+        self._states = array("B")
+        self._titles = []
+        self._hidden = 0
+        self._matches = None
+        # built in the background once the items are loaded and kept
+        # up to date after that; the searches scan the titles until
+        # it's ready
+        self._index = None
+        self._index_builder = None
+        # [(added, title)] changes made while the index is being built
+        self._index_changes = []
+        # {title: search_key(title)} for searching until then
+        self._search_keys = {}
+        self.filter_text = u""
+        # live item counts per state, see stats()
+        self._counts = [0, 0, 0]
+        self._emitted_stats = None
+        self._journal_records = []
+        # set when there may be items with empty titles to clean up
+        self._maybe_empty = False
+        # bumped on every change that needs to be saved
+        self._generation = 0
+        self._saved_generation = 0
+        self.cache = DatabaseCache(self.cache_budget())
+        self.writer = DatabaseWriter(self._written, self.use_binary())
+        self.summaries = NeedSummaries(self.db_dir())
+        self.history = TitleHistory(self.db_dir())
+        self._loaded_path = None
+        # database_signature() of the loaded database as we last saw it
+        self._disk_signature = None
+        # set when the next save has to rewrite the database file
+        self._snapshot_needed = False
+        # [(path, error)] writes that failed, see _written()
+        self._write_errors = []
+        self.connect(self, SIGNAL("writeFailed()"), self._write_failed,
+                     Qt.QueuedConnection)
+        self.show_all = True
+        self.setup_watcher()
         self.load_db_list()
         self.load()
-        self.sort(0, Qt.AscendingOrder)
-        self.connect(model, SIGNAL("dataChanged(QModelIndex, QModelIndex)"),
+        self.connect(self, SIGNAL("dataChanged(QModelIndex, QModelIndex)"),
                      self._dataChanged)
         self.save_timer = QTimer()
         self.save_timer.setSingleShot(True)
         self.save_timer.setInterval(SAVE_INTERVAL_MS)
         self.connect(self.save_timer, SIGNAL("timeout()"), self.save)
 
-    @property
-    def model(self):
-        return self.sourceModel()
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        if self._matches is not None:
+            return len(self._matches)
+        return len(self._titles) - self._hidden
+
+    def item_count(self):
+        return len(self._titles)
 
-    def setData(self, index, value, role):
-        if not self.show_all and role == Qt.CheckStateRole and \
-                value == Qt.Unchecked:
-            value = Qt.PartiallyChecked
-        return super(CheckListModel, self).setData(index, value, role)
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.NoItemFlags
+        if self._reader is not None:
+            # nothing can be changed until the database is loaded
+            return ITEM_FLAGS & ~(Qt.ItemIsEnabled | Qt.ItemIsEditable)
+        return ITEM_FLAGS
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= self.rowCount():
+            return QVariant()
+        i = self._item(index.row())
+        if role == Qt.DisplayRole or role == Qt.EditRole:
+            return QVariant(self._titles[i])
+        elif role == Qt.CheckStateRole:
+            return QVariant(self.state_to_check_state(self._states[i]))
+        return QVariant()
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if not index.isValid() or index.row() >= self.rowCount():
+            return False
+        if isinstance(value, QVariant):
+            value = value.toPyObject()
+        i = self._item(index.row())
+        state, title = self._states[i], self._titles[i]
+        if role == Qt.CheckStateRole:
+            check_state = int(value)
+            if not self.show_all and check_state == Qt.Unchecked:
+                check_state = Qt.PartiallyChecked
+            state = self.check_state_to_state(check_state)
+        elif role == Qt.EditRole:
+            # kept stripped like the titles read from the file
+            title = unicode(value).strip() if value is not None else u""
+            if not title:
+                self._maybe_empty = True
+        else:
+            return False
+        if state == self._states[i] and title == self._titles[i]:
+            return True
+        self._record_change(self._states[i], self._titles[i], state, title)
+        r = self._update_item(i, state, title)
+        self.emit(SIGNAL("dataChanged(QModelIndex, QModelIndex)"),
+                  self.index(r, 0), self.index(r, 0))
+        self._emit_stats()
+        return True
+
+    def _record_change(self, old_state, old_title, state, title):
+        # empty items are removed by cleanup() and never saved
+        old_title, title = old_title.strip(), title.strip()
+        if old_title:
+            self._journal_records.append(("-", old_state, old_title))
+        if title:
+            self._journal_records.append(("+", state, title))
+        self._generation += 1
+
+    def _find_position(self, state, title):
+        return find_position(self._states, self._titles, state, title)
+
+    def _update_item(self, i, state, title):
+        # Set the item's sort key and move it to its new sorted
+        # position. The item must stay visible, which is always the
+        # case as the Need view never makes items NOT_NEEDED and the
+        # search keeps showing the items edited while it's active.
+        # Returns the new view row of the item.
+        self._own_titles()
+        self._counts[self._states[i]] -= 1
+        self._counts[state] += 1
+        if title != self._titles[i]:
+            self._index_remove(self._titles[i])
+            self._index_add(title)
+        j = self._find_position(state, title)
+        if j > i:
+            j -= 1
+        r = self._view_row(i)
+        if j == i:
+            self._states[i] = state
+            self._titles[i] = title
+            return r
+        matches = self._matches
+        if matches is not None:
+            matches = matches[:r] + matches[r + 1:]
+            if j > i:
+                lo = bisect.bisect_right(matches, i)
+                hi = bisect.bisect_right(matches, j, lo)
+                delta = -1
+            else:
+                lo = bisect.bisect_left(matches, j)
+                hi = bisect.bisect_left(matches, i, lo)
+                delta = 1
+            for k in xrange(lo, hi):
+                matches[k] += delta
+            to_r = bisect.bisect_left(matches, j)
+            matches.insert(to_r, j)
+        else:
+            to_r = self._view_row(j)
+        # with a search active the item may keep its row, which Qt
+        # doesn't accept as a move
+        moved = to_r != r and self.beginMoveRows(
+            QModelIndex(), r, r, QModelIndex(), to_r + 1 if j > i else to_r)
+        del self._states[i]
+        del self._titles[i]
+        self._states.insert(j, state)
+        self._titles.insert(j, title)
+        self._matches = matches
+        if moved:
+            self.endMoveRows()
+        return to_r
 
     def db_dir(self):
-        return os.path.expanduser("~/MyDocs/.i4checklist")
+        return default_db_dir()
+
+    def cache_budget(self):
+        self.settings.beginGroup("cache")
+        try:
+            budget, ok = self.settings.value(
+                "budget", QVariant(DB_CACHE_BUDGET)).toInt()
+            return budget if ok else DB_CACHE_BUDGET
+        finally:
+            self.settings.endGroup()
+
+    def setup_watcher(self):
+        # The database directory and the loaded database are watched
+        # for changes made by other programs. Bursts of changes are
+        # handled together after WATCH_DELAY_MS. If the directory can't
+        # be watched, it's polled every POLL_INTERVAL_MS instead.
+        self._dir_signature = file_signature(self.db_dir())
+        self.watch_timer = QTimer()
+        self.watch_timer.setSingleShot(True)
+        self.watch_timer.setInterval(WATCH_DELAY_MS)
+        self.connect(self.watch_timer, SIGNAL("timeout()"), self.check_disk)
+        self.watcher = QFileSystemWatcher(self)
+        self.connect(self.watcher, SIGNAL("directoryChanged(QString)"),
+                     self.watch_timer.start)
+        self.connect(self.watcher, SIGNAL("fileChanged(QString)"),
+                     self.watch_timer.start)
+        self.watcher.addPath(self.db_dir())
+        self.poll_timer = QTimer()
+        self.poll_timer.setInterval(POLL_INTERVAL_MS)
+        self.connect(self.poll_timer, SIGNAL("timeout()"), self.check_disk)
+        if not self.watcher.directories():
+            log.warning("setup_watcher(): can't watch %s, polling it",
+                        self.db_dir())
+            self.poll_timer.start()
+
+    def _watch_files(self):
+        # files replaced by renaming are dropped by the watcher, so this
+        # is called again after each change
+        paths = []
+        if self._loaded_path is not None:
+            paths = [p for p in (self._loaded_path,
+                                 self._loaded_path + JOURNAL_SUFFIX)
+                     if os.path.exists(p)]
+        watched = [unicode(p) for p in self.watcher.files()]
+        for path in watched:
+            if path not in paths:
+                self.watcher.removePath(path)
+        for path in paths:
+            if path not in watched:
+                self.watcher.addPath(path)
+
+    def _written(self, path, error):
+        # called from the writer thread; a failed write may have
+        # changed the files too
+        if error is None:
+            self.cache.refresh(path)
+        else:
+            self.cache.discard(path)
+        if path == self._loaded_path:
+            self._disk_signature = database_signature(path)
+        if error is not None:
+            self._write_errors.append((path, error))
+            self.emit(SIGNAL("writeFailed()"))
+
+    def _write_failed(self):
+        # The changes the writer failed to write were already taken
+        # off the journal records, and the journal may have been
+        # partly written, so the loaded database is written in full on
+        # the next save. saveFailed(QString) reports the failures.
+        errors, self._write_errors = self._write_errors, []
+        names = []
+        for path, error in errors:
+            if path == self._loaded_path:
+                self._snapshot_needed = True
+                self._generation += 1
+            names.append("%s: %s" % (os.path.basename(path), error))
+        if names:
+            self.emit(SIGNAL("saveFailed(QString)"),
+                      "Failed to save the changes to:\n%s\nThe changes "
+                      "to the open database will be saved again." %
+                      "\n".join(names))
+
+    def check_disk(self):
+        dir_signature = file_signature(self.db_dir())
+        if dir_signature != self._dir_signature:
+            self._dir_signature = dir_signature
+            self.refresh_db_list()
+        if self.merge_external_changes():
+            self.save_timer.start()
+        self._watch_files()
+
+    def refresh_db_list(self):
+        # Applies the databases created and removed by other programs
+        # to the list and emits databasesChanged() if there are any.
+        # The loaded database stays in the list even if its file is
+        # gone, it's written again on the next save.
+        names = set(list_databases(self.db_dir()))
+        names.add(self.current_db)
+        known = set(self.databases)
+        if names == known:
+            return
+        for name in known - names:
+            self.databases.remove(name)
+            self.cache.discard(os.path.join(self.db_dir(), name))
+        for name in names - known:
+            bisect.insort(self.databases, name)
+        self.emit(SIGNAL("databasesChanged()"))
+
+    def merge_external_changes(self):
+        # Applies the changes made to the loaded database by other
+        # programs as row-level diffs. The local changes that aren't
+        # in the database file yet, the unsaved ones and the ones in
+        # a journal left from the previous version of the file, are
+        # replayed on top. The items they change that were changed or
+        # removed by the other program too are reported by emitting
+        # externalChange(QString). Returns true if anything changed.
+        # While the writer is still writing the database, the check is
+        # left to the next watcher tick instead of waiting for it.
+        path = self._loaded_path
+        if path is None or self.load_error is not None or \
+                self._reader is not None:
+            return False
+        if self.writer.pending(path):
+            self.watch_timer.start()
+            return False
+        signature = database_signature(path)
+        if signature == self._disk_signature:
+            return False
+        log.info("merge_external_changes(): %s changed", path)
+        journal = Journal(path)
+        stale = journal.stale_records()
+        rows = []
+        try:
+            if os.path.exists(path):
+                with open(path) as f:
+                    rows = sorted(parse_data(f))
+            rows = journal.read(rows)
+        except (ParseError, ValueError), e:
+            self._disk_signature = signature
+            log.error("merge_external_changes(): %s: %s", path, e)
+            self.load_error = str(e)
+            self.emit(SIGNAL("externalChange(QString)"),
+                      "Failed to load database '%s' changed by another "
+                      "program: %s\nChanges to it will not be saved." %
+                      (self.current_db, e))
+            return False
+        # a stale journal is kept until the snapshot below
+        self._disk_signature = signature
+        missing = []
+        rows = replay_journal(rows, stale + self._journal_records, missing)
+        if stale or missing:
+            # the journal no longer matches the file
+            self._journal_records = []
+            self._snapshot_needed = True
+            self._generation += 1
+        removed, added = diff_items(self._states, self._titles, rows)
+        if len(removed) + len(added) > len(rows) // 4 + 16:
+            self._set_items(*columns(rows))
+        else:
+            self._remove_items(removed)
+            self._insert_items(added)
+        if missing:
+            titles = sorted(set(title for state, title in missing))
+            self.emit(SIGNAL("externalChange(QString)"),
+                      "Database '%s' was changed both here and by "
+                      "another program. Please check these items:\n%s" %
+                      (self.current_db, "\n".join(titles)))
+        return bool(removed or added)
+
+    def use_binary(self):
+        # whether to keep the binary form of the databases for opening
+        # them without parsing
+        self.settings.beginGroup("database")
+        try:
+            return self.settings.value("binary", QVariant(True)).toBool()
+        finally:
+            self.settings.endGroup()
+
+    def _own_titles(self):
+        # the titles mapped from a binary database are read-only, so
+        # they're decoded before the first change
+        if not isinstance(self._titles, list):
+            self._titles = self._titles.decode()
 
     def load_db_list(self, ignore_current=False):
-        self.databases = []
-        for filename in sorted(os.listdir(self.db_dir())):
-            path = os.path.join(self.db_dir(), filename)
-            if os.path.isfile(path):
-                self.databases.append(filename)
+        self.databases = list_databases(self.db_dir())
         if not self.databases:
             self.databases = ["default"]
         self.current_db = self.databases[0]
@@ -233,15 +639,19 @@ class CheckListModel(QSortFilterProxyModel):
         else: # NEED
             return NEED
 
-    def make_row(self, state, title):
-        item = QStandardItem(title) if title else QStandardItem()
-        item.setFlags(
-            Qt.ItemIsUserCheckable | Qt.ItemIsTristate | Qt.ItemIsEnabled |
-            Qt.ItemIsEditable)
-        item.setData(self.state_to_check_state(state), Qt.CheckStateRole)
-        return [item]
-
+    @profile.timed("load")
     def load(self, db_name=None):
+        # Loads the database and emits loaded() once it's complete. With
+        # background set, a database that has to be parsed is read by
+        # a DatabaseReader: load() returns right away and the items are
+        # added every LOAD_INTERVAL_MS as they're parsed. Until then
+        # they can't be changed; finish_loading() waits for them.
+        self._stop_loading()
+        if self._loaded_path is not None and self.load_error is None and \
+                self._generation == self._saved_generation:
+            # keep the saved database around for switching back to it
+            self.cache.put(self._loaded_path, self._states, self._titles,
+                           self._disk_signature)
         if db_name is not None:
             if not db_name in self.databases:
                 self.databases.append(db_name)
@@ -253,36 +663,171 @@ class CheckListModel(QSortFilterProxyModel):
             finally:
                 self.settings.endGroup()
         path = os.path.join(self.db_dir(), self.current_db)
-        log.debug("load(): %s" % path)
-        self.model.removeRows(0, self.model.rowCount())
-        if not os.path.exists(path):
+        log.debug("load(): %s", path)
+        self.writer.flush(path)
+        self.load_error = None
+        self._journal_records = []
+        self._saved_generation = self._generation
+        self._snapshot_needed = False
+        self._loaded_path = path
+        self._disk_signature = database_signature(path)
+        # the items are parsed straight into the arrays and published
+        # with a single model reset
+        states, titles = array("B"), []
+        ordered = False
+        cached = self.cache.take(path)
+        if cached is None and self.writer.binary:
+            mapped = open_binary(path)
+        else:
+            mapped = None
+        if cached is not None:
+            log.debug("load(): using cached %s", path)
+            states, titles = cached
+            ordered = True
+        elif mapped is not None:
+            # the titles are decoded as they're displayed
+            log.debug("load(): using %s%s", path, BINARY_SUFFIX)
+            states, titles = mapped
+            ordered = True
+        elif os.path.exists(path) and self.background:
+            self._reader = DatabaseReader(path)
+            self._set_items(states, titles, False)
+            self._watch_files()
+            self.load_timer.start()
+            return
+        elif os.path.exists(path):
+            with open(path) as f:
+                try:
+                    ordered = read_columns(parse_data(f), states, titles)
+                except ParseError, e:
+                    log.error("load(): %s: %s", path, e)
+                    self.load_error = str(e)
+        journal = Journal(path)
+        if cached is None and self.load_error is None and journal.exists():
+            try:
+                rows = journal.read(zip(states, titles))
+            except (ParseError, ValueError), e:
+                log.error("load(): %s%s: %s", path, JOURNAL_SUFFIX, e)
+                self.load_error = str(e)
+            else:
+                states, titles = columns(rows)
+        if not ordered:
+            start = time.time()
+            states, titles = columns(sorted(izip(states, titles)))
+            if profile.enabled:
+                profile.add_time("sort", time.time() - start)
+        self._set_items(states, titles, cached is not None)
+        self._watch_files()
+        self.emit(SIGNAL("loaded()"))
+
+    def loading(self):
+        return self._reader is not None
+
+    def _load_chunks(self):
+        # adds the items the reader parsed since the last time
+        reader = self._reader
+        chunks, done = reader.take()
+        for states, titles in chunks:
+            self._append_items(states, titles)
+        if not done:
             return
-        with open(path) as f:
-            for state, title in parse_data(f):
-                self.model.appendRow(self.make_row(state, title))
+        self.load_timer.stop()
+        self._reader = None
+        if reader.error is not None:
+            log.error("load(): %s: %s", reader.path, reader.error)
+            self.load_error = reader.error
+        if reader.rows is not None:
+            self._set_items(reader.rows[0], reader.rows[1])
+        else:
+            self._build_index()
+            # the items are enabled now
+            self.emit(SIGNAL("layoutAboutToBeChanged()"))
+            self.emit(SIGNAL("layoutChanged()"))
+        self.emit(SIGNAL("loaded()"))
+
+    def finish_loading(self):
+        # waits until the database being loaded is complete
+        if self._reader is not None:
+            self._reader.wait()
+            self._load_chunks()
+
+    def _stop_loading(self):
+        # abandons the database being loaded
+        if self._reader is not None:
+            self.load_timer.stop()
+            self._reader.cancel()
+            self._reader = None
+            # don't keep the items read so far in the cache
+            self._loaded_path = None
 
-    def save(self):
+    def _set_items(self, states, titles, maybe_empty=True):
+        # replaces the items with a single model reset
+        self.beginResetModel()
+        try:
+            self._states, self._titles = states, titles
+            self._counts = count_states(states)
+            self._maybe_empty = maybe_empty or u"" in titles
+            self._build_index()
+            self._refilter()
+        finally:
+            self.endResetModel()
+        self._emit_stats()
+
+    @profile.timed("save")
+    def save(self, compact=False):
+        # Changes are appended to the journal; the database file is
+        # only rewritten when the journal grows too large, when it
+        # doesn't exist yet or when compact is true. The actual writing
+        # is done by the writer thread.
         path = os.path.join(self.db_dir(), self.current_db)
-        log.debug("save(): %s" % path)
+        self.save_timer.stop()
+        self.finish_loading()
+        # don't overwrite the changes made by other programs
+        self.merge_external_changes()
+        if self.load_error is not None:
+            # don't overwrite the part of the file that wasn't parsed
+            log.warning("save(): not saving %s that failed to load", path)
+            return
+        if compact:
+            self.writer.flush()
+        exists = os.path.exists(path)
+        journal = Journal(path)
+        if exists and self._generation == self._saved_generation and \
+                not (compact and journal.exists()):
+            return
+        log.debug("save(): %s", path)
         self.cleanup()
         if not os.path.exists(os.path.dirname(path)):
             os.makedirs(os.path.dirname(path))
-        data = []
-        for i in range(0, self.model.rowCount()):
-            index = self.model.index(i, 0)
-            v1 = self.check_state_to_state(
-                index.data(Qt.CheckStateRole).toPyObject())
-            v2 = unicode(index.data().toPyObject())
-            data.append((v1, v2))
-        data.sort()
-        with open(path, "wt+") as f:
-            serialize_data(data, f)
-        self.save_timer.stop()
+        records, self._journal_records = self._journal_records, []
+        self._saved_generation = self._generation
+        # the items put on the list since the last save
+        self.history.use([record[2] for record in records
+                          if record[0] == "+" and record[1] == NEED])
+        if exists and not compact and not self._snapshot_needed and \
+                journal.size() < JOURNAL_COMPACT_SIZE:
+            self.writer.submit(path, records)
+        else:
+            # the rows are already sorted
+            self.writer.submit(path, [], zip(self._states, self._titles))
+            self._snapshot_needed = False
+
+    def flush(self):
+        self.writer.flush()
+        self.history.flush()
 
     def delete_database(self):
         path = os.path.join(self.db_dir(), self.current_db)
+        self._stop_loading()
+        self.writer.flush()
         if os.path.exists(path):
             os.unlink(path)
+        Journal(path).remove()
+        if os.path.exists(path + BINARY_SUFFIX):
+            os.unlink(path + BINARY_SUFFIX)
+        self._journal_records = []
+        self._loaded_path = None
+        self.cache.discard(path)
         self.load_db_list(True)
         self.load()
 
@@ -293,43 +838,282 @@ class CheckListModel(QSortFilterProxyModel):
             QTimer.singleShot(1, self.cleanup)
         self.save_timer.start()
 
+    def _refilter(self):
+        self._hidden = 0 if self.show_all else self._counts[NOT_NEEDED]
+        if not search_words(self.filter_text):
+            self._matches = None
+            return
+        if self._update_index() is None:
+            self._matches = self._scan(self._titles, self._hidden)
+            return
+        self._matches = filter_items(
+            self._states, self._titles,
+            self._index.search(self.filter_text), self._hidden)
+
+    def _build_index(self):
+        # starts building the index of the items once they're loaded
+        if self._index_builder is not None:
+            self._index_builder.cancel()
+            self._index_builder = None
+        self._index = None
+        self._index_changes = []
+        self._search_keys = {}
+        if self._reader is None:
+            titles = self._titles
+            if isinstance(titles, list):
+                # _own_titles() replaces the mapped ones instead
+                titles = titles[:]
+            self._index_builder = IndexBuilder(titles, self._search_keys)
+
+    def _update_index(self):
+        # returns the index if it's ready
+        builder = self._index_builder
+        if builder is not None and builder.done():
+            self._index = builder.index
+            self._index_builder = None
+            for added, title in self._index_changes:
+                if added:
+                    self._index.add(title)
+                else:
+                    self._index.remove(title)
+            self._index_changes = []
+            self._search_keys = {}
+        return self._index
+
+    def _index_add(self, title):
+        if self._index is not None:
+            self._index.add(title)
+        elif self._index_builder is not None:
+            self._index_changes.append((True, title))
+
+    def _index_remove(self, title):
+        if self._index is not None:
+            self._index.remove(title)
+        elif self._index_builder is not None:
+            self._index_changes.append((False, title))
+
+    def _search(self, titles):
+        # the set of the titles matching the search, including those
+        # among titles
+        if self._update_index() is not None:
+            return self._index.search(self.filter_text)
+        return set(titles[i] for i in self._scan(titles))
+
+    def _scan(self, titles, start=0):
+        # scan_titles() with the index being built paused
+        builder = self._index_builder
+        if builder is not None:
+            builder.paused = True
+        try:
+            return scan_titles(titles, self.filter_text, self._search_keys,
+                               start)
+        finally:
+            if builder is not None:
+                builder.paused = False
+
+    def _item(self, r):
+        if self._matches is not None:
+            return self._matches[r]
+        return r + self._hidden
+
+    def _view_row(self, i):
+        if self._matches is not None:
+            r = bisect.bisect_left(self._matches, i)
+            if r < len(self._matches) and self._matches[r] == i:
+                return r
+            return None
+        if i < self._hidden:
+            return None
+        return i - self._hidden
+
+    @profile.timed("layout")
+    def _change_layout(self, items=(), state=None):
+        # Sets the state of the items (a sorted list of indices), then
+        # re-sorts and re-filters the rows with one layout change.
+        # Persistent indices (the current item, an open editor) follow
+        # their items.
+        self.emit(SIGNAL("layoutAboutToBeChanged()"))
+        persistent = []
+        for index in self.persistentIndexList():
+            i = self._item(index.row())
+            k = bisect.bisect_left(items, i)
+            changed = k < len(items) and items[k] == i
+            persistent.append((index, state if changed else self._states[i],
+                               self._titles[i]))
+        if items:
+            for i in items:
+                self._counts[self._states[i]] -= 1
+            self._counts[state] += len(items)
+            self._states, self._titles = change_states(
+                self._states, self._titles, items, state)
+        self._refilter()
+        for index, item_state, title in persistent:
+            r = self._view_row(self._find_position(item_state, title))
+            self.changePersistentIndex(
+                index, QModelIndex() if r is None else self.index(r, 0))
+        self.emit(SIGNAL("layoutChanged()"))
+        self._emit_stats()
+
+    def _remove_items(self, items):
+        # Removes the items (a sorted list of indices) with one
+        # beginRemoveRows()/endRemoveRows() per contiguous range,
+        # starting from the end so that the indices stay valid.
+        ranges = []
+        for i in items:
+            if ranges and ranges[-1][1] == i:
+                ranges[-1][1] = i + 1
+            else:
+                ranges.append([i, i + 1])
+        for start, end in reversed(ranges):
+            self._own_titles()
+            if self._matches is not None:
+                r1 = bisect.bisect_left(self._matches, start)
+                r2 = bisect.bisect_left(self._matches, end, r1)
+            else:
+                r1 = max(start - self._hidden, 0)
+                r2 = max(end - self._hidden, 0)
+            if r1 < r2:
+                self.beginRemoveRows(QModelIndex(), r1, r2 - 1)
+            for state in self._states[start:end]:
+                self._counts[state] -= 1
+            for title in self._titles[start:end]:
+                self._index_remove(title)
+            del self._states[start:end]
+            del self._titles[start:end]
+            # the hidden items are the ones in front of the view
+            self._hidden -= min(end, self._hidden) - min(start, self._hidden)
+            if self._matches is not None:
+                n = end - start
+                self._matches[r1:] = [i - n for i in self._matches[r2:]]
+            if r1 < r2:
+                self.endRemoveRows()
+        self._emit_stats()
+
+    def _append_items(self, states, titles):
+        # Adds the sorted items, which sort after all the others, e.g.
+        # the next chunk of a database being loaded, with one
+        # beginInsertRows()/endInsertRows(). As the NOT_NEEDED items
+        # come first, the ones appended are always after the hidden
+        # ones in the Need view.
+        if not titles:
+            return
+        self._own_titles()
+        n = len(self._titles)
+        counts = count_states(states)
+        hidden = 0 if self.show_all else counts[NOT_NEEDED]
+        for title in titles:
+            self._index_add(title)
+        if self._matches is not None:
+            found = self._search(titles)
+            matches = [n + k for k in xrange(hidden, len(titles))
+                       if titles[k] in found]
+            first, shown = len(self._matches), len(matches)
+        else:
+            first, shown = n - self._hidden, len(titles) - hidden
+        if shown:
+            self.beginInsertRows(QModelIndex(), first, first + shown - 1)
+        self._states.extend(states)
+        self._titles.extend(titles)
+        for state in (NOT_NEEDED, NEED, CHECKED):
+            self._counts[state] += counts[state]
+        self._hidden += hidden
+        if self._matches is not None:
+            self._matches.extend(matches)
+        if shown:
+            self.endInsertRows()
+        if [title for title in titles if not title.strip()]:
+            self._maybe_empty = True
+        self._emit_stats()
+
+    def _insert_items(self, rows):
+        # Inserts the (state, title) rows, which must be sorted, at
+        # their positions with one beginInsertRows()/endInsertRows()
+        # per row shown. While a search is active, only the rows
+        # matching it are shown.
+        if not rows:
+            return
+        self._own_titles()
+        found = None
+        for state, title in rows:
+            self._index_add(title)
+        if self._matches is not None:
+            found = self._search([title for state, title in rows])
+        for state, title in rows:
+            i = self._find_position(state, title)
+            if self._matches is not None:
+                r = bisect.bisect_left(self._matches, i)
+                shown = title in found and (self.show_all or
+                                            state != NOT_NEEDED)
+            else:
+                r = i - self._hidden
+                shown = self.show_all or state != NOT_NEEDED
+            if shown:
+                self.beginInsertRows(QModelIndex(), r, r)
+            self._states.insert(i, state)
+            self._titles.insert(i, title)
+            self._counts[state] += 1
+            if not self.show_all and state == NOT_NEEDED:
+                self._hidden += 1
+            if self._matches is not None:
+                self._matches[r:] = ([i] if shown else []) + \
+                    [k + 1 for k in self._matches[r:]]
+            if shown:
+                self.endInsertRows()
+        if [title for state, title in rows if not title.strip()]:
+            self._maybe_empty = True
+        self._emit_stats()
+
+    @profile.timed("cleanup")
     def cleanup(self, check_values=None):
-        i = 0
-        while i < self.model.rowCount():
-            index = self.model.index(i, 0)
-            value = index.data().toPyObject()
-            value = value and unicode(value).strip()
-            if not value:
-                self.model.removeRow(i)
-                continue
-            check_value = int(index.data(Qt.CheckStateRole).toPyObject())
-            if check_values and check_value in check_values:
-                self.model.setData(index, Qt.Unchecked, Qt.CheckStateRole)
-            i += 1
+        self.finish_loading()
+        if self._maybe_empty:
+            self._maybe_empty = False
+            self._remove_items(empty_items(self._titles))
+        reset_states = frozenset(
+            self.check_state_to_state(v) for v in check_values or ())
+        items = state_items(self._states,
+                            reset_states - frozenset([NOT_NEEDED]))
+        if items:
+            self._journal_records.append(("R", reset_states))
+            self._generation += 1
+            self._change_layout(items, NOT_NEEDED)
+            self.save_timer.start()
         self._updatePending = False
 
-    def lessThan(self, left, right):
-        # log.debug("left %d %d right %d %d" % (left.row(), left.column(), right.row(), right.column()))
-        r = super(CheckListModel, self).lessThan(left, right)
-        if r:
-            return True
-        if super(CheckListModel, self).lessThan(right, left):
-            return False
-        return unicode(left.data().toPyObject()) < unicode(right.data().toPyObject())
+    def sort(self, column, order=Qt.AscendingOrder):
+        # the rows are always kept sorted
+        pass
 
     def set_show_all(self, show_all):
         self.show_all = show_all
-        if show_all:
-            self.setFilterRegExp("")
-        else:
-            self.setFilterRegExp(
-                QRegExp("^%d|%d$" % (Qt.Checked, Qt.PartiallyChecked)))
+        self._change_layout()
+
+    def set_filter_text(self, text):
+        # shows only the items matching text, see TitleIndex.search()
+        self.filter_text = unicode(text)
+        self._change_layout()
 
     def new(self):
         self.cleanup()
-        self.model.insertRow(0, self.make_row(NEED, None))
+        # the empty title goes first among the needed items
+        self._own_titles()
+        i = self._counts[NOT_NEEDED]
+        if self._matches is not None:
+            r = bisect.bisect_left(self._matches, i)
+        else:
+            r = self._view_row(i)
+        self.beginInsertRows(QModelIndex(), r, r)
+        self._states.insert(i, NEED)
+        self._titles.insert(i, u"")
+        self._counts[NEED] += 1
+        self._maybe_empty = True
+        self._index_add(u"")
+        if self._matches is not None:
+            self._matches[r:] = [i] + [k + 1 for k in self._matches[r:]]
+        self.endInsertRows()
+        self._emit_stats()
         self.save_timer.stop()
-        return self.mapFromSource(self.model.index(0, 0))
+        return self.index(r, 0)
 
     def checkout(self):
         self.cleanup((Qt.Checked,))
@@ -338,28 +1122,191 @@ class CheckListModel(QSortFilterProxyModel):
         self.cleanup((Qt.Checked, Qt.PartiallyChecked))
 
     def need_anything(self):
-        for i in range(0, self.model.rowCount()):
-            index = self.model.index(i, 0)
-            v = self.check_state_to_state(
-                index.data(Qt.CheckStateRole).toPyObject())
-            if v != NOT_NEEDED:
-                return True
-        return False
+        return self._counts[NEED] + self._counts[CHECKED] > 0
+
+    def needed_everywhere(self):
+        # [(db_name, rows)] with the sorted NEED and CHECKED items of
+        # all the databases; rows is None for the ones that failed to
+        # load. The loaded database is saved first so that its summary
+        # matches the file.
+        self.save()
+        self.writer.flush()
+        if self.load_error is None:
+            path = os.path.join(self.db_dir(), self.current_db)
+            rows = [(self._states[i], self._titles[i])
+                    for i in xrange(self._counts[NOT_NEEDED],
+                                    len(self._titles))
+                    if self._titles[i]]
+            self.summaries.put(self.current_db, rows,
+                               database_signature(path))
+        result = self.summaries.get(self.databases)
+        self.summaries.save()
+        return result
+
+    def change_state(self, db_name, state, title, new_state):
+        # Changes the state of an item of any of the databases. The
+        # loaded one is changed here and saved as usual, the others get
+        # the change appended to their journals. Returns false if the
+        # item isn't there or the database changed since its summary
+        # was read.
+        if db_name == self.current_db:
+            self.finish_loading()
+            i = self._find_position(state, title)
+            if i == len(self._titles) or self._states[i] != state or \
+                    self._titles[i] != title:
+                return False
+            self._record_change(state, title, new_state, title)
+            self._change_layout([i], new_state)
+            self.save_timer.start()
+            return True
+        path = os.path.join(self.db_dir(), db_name)
+        self.writer.flush(path)
+        if not self.summaries.is_current(db_name):
+            return False
+        try:
+            Journal(path).append([("-", state, title),
+                                  ("+", new_state, title)])
+        except EnvironmentError, e:
+            log.error("change_state(): %s: %s", path, e)
+            return False
+        self.cache.discard(path)
+        self.summaries.change(db_name, state, title, new_state,
+                              database_signature(path))
+        return True
+
+    def stats(self):
+        # (NOT_NEEDED, NEED, CHECKED) item counts; statsChanged(int,
+        # int, int) is emitted with the new counts when they change
+        return tuple(self._counts)
+
+    def count(self, state):
+        return self._counts[state]
+
+    def _emit_stats(self):
+        stats = tuple(self._counts)
+        if stats != self._emitted_stats:
+            self._emitted_stats = stats
+            self.emit(SIGNAL("statsChanged(int, int, int)"), *stats)
+
+class NeedListModel(QAbstractListModel):
+    # What's needed in all the databases: a heading with the name of
+    # each database followed by its NEED and CHECKED items. Checking
+    # the items writes them back to their databases, see
+    # CheckListModel.change_state().
+    def __init__(self, checklist, parent=None):
+        super(NeedListModel, self).__init__(parent)
+        self.checklist = checklist
+        # (db_name, state, title); state is None for the headings
+        self._rows = []
+        self.heading_font = QFont()
+        self.heading_font.setBold(True)
+        self.reload()
+
+    def reload(self):
+        self.beginResetModel()
+        try:
+            self._rows = []
+            for db_name, items in self.checklist.needed_everywhere():
+                heading = re.sub("\\.org$", "", db_name)
+                if items is None:
+                    self._rows.append(
+                        (db_name, None, heading + " (failed to load)"))
+                elif items:
+                    self._rows.append((db_name, None, heading))
+                    self._rows.extend((db_name, state, title)
+                                      for state, title in items)
+        finally:
+            self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self._rows)
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.NoItemFlags
+        if self._rows[index.row()][1] is None:
+            return Qt.ItemIsEnabled
+        return Qt.ItemIsUserCheckable | Qt.ItemIsTristate | Qt.ItemIsEnabled
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self._rows):
+            return QVariant()
+        db_name, state, title = self._rows[index.row()]
+        if role == Qt.DisplayRole:
+            return QVariant(title)
+        elif role == Qt.CheckStateRole and state is not None:
+            return QVariant(self.checklist.state_to_check_state(state))
+        elif role == Qt.FontRole and state is None:
+            return QVariant(self.heading_font)
+        return QVariant()
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if not index.isValid() or index.row() >= len(self._rows) or \
+                role != Qt.CheckStateRole:
+            return False
+        db_name, state, title = self._rows[index.row()]
+        if state is None:
+            return False
+        if isinstance(value, QVariant):
+            value = value.toPyObject()
+        new_state = self.checklist.check_state_to_state(int(value))
+        if new_state == NOT_NEEDED:
+            new_state = NEED
+        if new_state == state:
+            return True
+        if not self.checklist.change_state(db_name, state, title,
+                                           new_state):
+            # the database changed behind our back, show it as it is
+            QTimer.singleShot(0, self.reload)
+            return False
+        self._rows[index.row()] = db_name, new_state, title
+        self.emit(SIGNAL("dataChanged(QModelIndex, QModelIndex)"),
+                  index, index)
+        return True
+
+class NeedDialog(QDialog):
+    def __init__(self, checklist, parent=None):
+        QDialog.__init__(self, parent)
+        self.setWindowTitle("Need everywhere")
+        self.model = NeedListModel(checklist, self)
+        self.view = QListView()
+        self.view.setUniformItemSizes(True)
+        self.cbdelegate = CheckBoxDelegate(item_height=ITEM_HEIGHT)
+        self.view.setSelectionMode(QAbstractItemView.NoSelection)
+        self.view.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.view.setItemDelegate(self.cbdelegate)
+        self.view.setModel(self.model)
+        box = QVBoxLayout(self)
+        box.addWidget(self.view)
 
 class I4CheckWindow(QWidget):
     def __init__(self, parent=None):
         QWidget.__init__(self, parent)
         self.setup_model()
 
-        self.tableview = QTableView()
-        self.tableview.setSelectionMode(QAbstractItemView.NoSelection)
-        self.tableview.setEditTriggers(QAbstractItemView.DoubleClicked)
-        self.cbdelegate = CheckBoxDelegate()
-        self.tableview.setItemDelegate(self.cbdelegate)
-        self.tableview.setAutoScroll(False)
-        self.tableview.setModel(self.model)
-        self.tableview.sortByColumn(0, Qt.AscendingOrder)
-        self.adjust_headers()
+        # With uniform rows the list view only measures one item and
+        # lays out the rest by arithmetic. Rows fitting their contents
+        # are an option, but every filter change then re-measures all
+        # the rows.
+        self.variable_height = self.use_variable_height()
+        if self.variable_height:
+            self.view = QTableView()
+            self.cbdelegate = CheckBoxDelegate(history=self.model.history)
+        else:
+            self.view = QListView()
+            self.view.setUniformItemSizes(True)
+            self.cbdelegate = CheckBoxDelegate(item_height=ITEM_HEIGHT,
+                                               history=self.model.history)
+        self.view.setSelectionMode(QAbstractItemView.NoSelection)
+        self.view.setEditTriggers(QAbstractItemView.DoubleClicked)
+        self.view.setItemDelegate(self.cbdelegate)
+        self.view.setAutoScroll(False)
+        self.view.setModel(self.model)
+        if self.variable_height:
+            self.view.sortByColumn(0, Qt.AscendingOrder)
+            self.adjust_headers()
 
         #self.model.setHeaderData(0, Qt.Horizontal, u"")
         #self.model.setHeaderData(1, Qt.Horizontal, u"Title")
@@ -378,12 +1325,30 @@ class I4CheckWindow(QWidget):
         self.connect(
             self.db_combo, SIGNAL("currentIndexChanged(int)"),
             self.db_index_changed)
+        self.connect(self.model, SIGNAL("databasesChanged()"),
+                     self.update_db_combo)
+        self.connect(self.model, SIGNAL("externalChange(QString)"),
+                     self.external_change)
+        self.connect(self.model, SIGNAL("saveFailed(QString)"),
+                     self.save_failed)
 
         self.new_button = QPushButton("New")
         self.connect(self.new_button, SIGNAL("clicked()"), self.new_item)
 
+        find_label = QLabel("Find:")
+        find_label.setFixedWidth(60)
+        find_label.setAlignment(Qt.AlignHCenter | Qt.AlignVCenter)
+        self.find_edit = QLineEdit()
+        self.find_edit.setInputMethodHints(Qt.ImhNoAutoUppercase)
+        self.connect(self.find_edit, SIGNAL("textChanged(QString)"),
+                     self.set_filter_text)
+
         self.box = QVBoxLayout(self)
-        self.box.addWidget(self.tableview)
+        self.find_box = QHBoxLayout()
+        self.find_box.addWidget(find_label)
+        self.find_box.addWidget(self.find_edit)
+        self.box.addLayout(self.find_box)
+        self.box.addWidget(self.view)
         self.button_box = QHBoxLayout()
         self.button_box.setSpacing(0)
         self.button_box.addWidget(self.new_button)
@@ -399,45 +1364,78 @@ class I4CheckWindow(QWidget):
         # }
         # """)
 
-        self.dwim_after_load()
+        self.connect(self.model, SIGNAL("loaded()"), self.dwim_after_load)
+        if not self.model.loading():
+            self.dwim_after_load()
 
     def dwim_after_load(self):
+        if self.model.load_error is not None:
+            QMessageBox.warning(
+                self, "Error",
+                "Failed to load database '%s': %s\n"
+                "Changes to it will not be saved." %
+                (self.model.current_db, self.model.load_error))
         if self.model.need_anything():
             self.radio_need.setChecked(True)
             return
         self.radio_all.setChecked(True)
-        if self.model.model.rowCount() == 0:
+        if self.model.item_count() == 0:
             edit_index = self.model.new()
-            self.tableview.setCurrentIndex(edit_index)
-            self.tableview.scrollTo(edit_index)
-            self.tableview.edit(edit_index)
+            self.view.setCurrentIndex(edit_index)
+            self.view.scrollTo(edit_index)
+            self.view.edit(edit_index)
+
+    def changeEvent(self, event):
+        if event.type() in (QEvent.StyleChange, QEvent.PaletteChange,
+                            QEvent.FontChange):
+            self.cbdelegate.clear_cache()
+        QWidget.changeEvent(self, event)
+
+    def use_variable_height(self):
+        settings = self.model.settings
+        settings.beginGroup("view")
+        try:
+            return settings.value(
+                "variable_height", QVariant(False)).toBool()
+        finally:
+            settings.endGroup()
+
+    def resize_rows(self):
+        if self.variable_height:
+            self.view.resizeRowsToContents()
 
     def adjust_headers(self):
         log.debug("adjust_sizes()")
-        self.tableview.horizontalHeader().setResizeMode(0, QHeaderView.Stretch)
-        self.tableview.setColumnWidth(0, 1)
-        self.tableview.verticalHeader().setDefaultSectionSize(ITEM_HEIGHT)
-        self.tableview.verticalHeader().hide()
-        self.tableview.horizontalHeader().hide()
+        self.view.horizontalHeader().setResizeMode(0, QHeaderView.Stretch)
+        self.view.setColumnWidth(0, 1)
+        self.view.verticalHeader().setDefaultSectionSize(ITEM_HEIGHT)
+        self.view.verticalHeader().hide()
+        self.view.horizontalHeader().hide()
 
     def setup_model(self):
-        self.model = CheckListModel()
+        # the window shows up while the database is being parsed
+        self.model = CheckListModel(background=True)
 
     def new_item(self):
         index = self.model.new()
-        self.tableview.setCurrentIndex(index)
-        self.tableview.resizeRowToContents(index.row())
-        self.tableview.scrollTo(index)
-        self.tableview.edit(index)
+        self.view.setCurrentIndex(index)
+        if self.variable_height:
+            self.view.resizeRowToContents(index.row())
+        self.view.scrollTo(index)
+        self.view.edit(index)
 
     def set_show_all(self, show_all):
         if self.model.show_all == show_all:
             return
         self.model.set_show_all(show_all)
-        self.tableview.resizeRowsToContents()
+        self.resize_rows()
 
-    def save(self):
-        self.model.save()
+    def set_filter_text(self, text):
+        self.model.set_filter_text(text)
+        self.resize_rows()
+
+    def save(self, compact=False):
+        self.model.save(compact)
 
     def checkout(self):
         if QMessageBox.question(
@@ -454,6 +1452,9 @@ class I4CheckWindow(QWidget):
             self.model.reset_items()
             self.radio_all.setChecked(True)
 
+    def show_needed_everywhere(self):
+        NeedDialog(self.model, self).exec_()
+
     def delete_database(self):
         if QMessageBox.question(
             self, "Delete database",
@@ -462,7 +1463,6 @@ class I4CheckWindow(QWidget):
             QMessageBox.Yes:
             self.model.delete_database()
             self.populate_db_combo()
-            self.dwim_after_load()
 
     _loading_db_combo = False
 
@@ -478,6 +1478,36 @@ class I4CheckWindow(QWidget):
         finally:
             self._loading_db_combo = False
 
+    def update_db_combo(self):
+        # applies the changes to the database list to the combo box
+        # item by item; both are sorted and "New database..." is last
+        self._loading_db_combo = True
+        try:
+            names = self.model.databases
+            i = 0
+            while i < len(names) or i < self.db_combo.count() - 1:
+                item = None
+                if i < self.db_combo.count() - 1:
+                    item = str(self.db_combo.itemData(i).toPyObject())
+                if i < len(names) and item == names[i]:
+                    i += 1
+                elif i < len(names) and (item is None or names[i] < item):
+                    self.db_combo.insertItem(
+                        i, re.sub("\\.org$", "", names[i]), names[i])
+                    i += 1
+                else:
+                    self.db_combo.removeItem(i)
+            self.db_combo.setCurrentIndex(
+                self.model.databases.index(self.model.current_db))
+        finally:
+            self._loading_db_combo = False
+
+    def external_change(self, message):
+        QMessageBox.warning(self, "Database changed", message)
+
+    def save_failed(self, message):
+        QMessageBox.critical(self, "Save failed", message)
+
     def db_index_changed(self, index):
         if self._loading_db_combo:
             return
@@ -489,7 +1519,6 @@ class I4CheckWindow(QWidget):
 
         if db_name:
             self.model.load(db_name)
-            self.dwim_after_load()
             return
 
         db_name, ok = QInputDialog.getText(
@@ -512,7 +1541,6 @@ class I4CheckWindow(QWidget):
         db_name = str(db_name) + ".org"
         self.model.load(db_name)
         self.populate_db_combo()
-        self.dwim_after_load()
 
 class I4CheckMainWindow(QMainWindow):
     def __init__(self):
@@ -524,7 +1552,11 @@ class I4CheckMainWindow(QMainWindow):
         self.setAttribute(Qt.WA_Maemo5AutoOrientation)
 
     def closeEvent(self, event):
-        self.checklist.save()
+        # leave a complete .org file behind for other tools
+        self.checklist.save(compact=True)
+        self.checklist.model.flush()
+        if profile.enabled:
+            self.save_profile()
         super(I4CheckMainWindow, self).closeEvent(event)
 
     def setup_menu(self):
@@ -532,6 +1564,8 @@ class I4CheckMainWindow(QMainWindow):
         self.act_checkout.triggered.connect(self.checklist.checkout)
         self.act_reset = QAction(self.tr('Reset'), self)
         self.act_reset.triggered.connect(self.checklist.reset_items)
+        self.act_need = QAction(self.tr('Need everywhere'), self)
+        self.act_need.triggered.connect(self.checklist.show_needed_everywhere)
         self.act_del_db = QAction(self.tr('Delete database'), self)
         self.act_del_db.triggered.connect(self.checklist.delete_database)
         self.act_about = QAction(self.tr('About'), self)
@@ -539,8 +1573,39 @@ class I4CheckMainWindow(QMainWindow):
         menu_bar = self.menuBar()
         menu_bar.addAction(self.act_checkout)
         menu_bar.addAction(self.act_reset)
+        menu_bar.addAction(self.act_need)
         menu_bar.addAction(self.act_del_db)
+        if profile.enabled:
+            self.act_profile = QAction(self.tr('Profile'), self)
+            self.act_profile.triggered.connect(self.show_profile)
+            menu_bar.addAction(self.act_profile)
         menu_bar.addAction(self.act_about)
+        self.connect(self.checklist.model,
+                     SIGNAL("statsChanged(int, int, int)"),
+                     self.update_actions)
+        self.update_actions(*self.checklist.model.stats())
+
+    def update_actions(self, not_needed, need, checked):
+        self.act_checkout.setEnabled(checked > 0)
+        self.act_reset.setEnabled(need + checked > 0)
+
+    def save_profile(self):
+        path = os.path.expanduser(PROFILE_FILE)
+        try:
+            with open(path, "w") as f:
+                f.write(profile.report())
+        except EnvironmentError, e:
+            log.error("save_profile(): %s: %s", path, e)
+            return None
+        return path
+
+    def show_profile(self):
+        # saves the profile for sending it from the device
+        report = profile.report()
+        path = self.save_profile()
+        if path is not None:
+            report += "\nSaved to %s" % path
+        QMessageBox.information(self, "Profile", report)
 
     def about(self):
         QMessageBox.information(
@@ -549,19 +1614,27 @@ class I4CheckMainWindow(QMainWindow):
             "inspired by Handy Shopper for Palm OS.\n\n"
             "(c) Copyright Ivan Shvedunov 2010")
 
-# TBD: QSortFilterProxyModel still fscks up unpredictably after setFilterRegExp()...
 # TBD: onscreen keyboard compatibility
-# TBD: disable checkout menu item when there are no checked items
-# TBD: separate logic, write more tests
-# TBD: reduce N of redundant saves
+# TBD: write more tests
 # TBD: main menu (remove database, etc.)
 # TBD: style using qss
-# TBD: don't crash on parse errors
 # TBD: invent more convenient org format
 
-#test_it()
-logging.basicConfig(level=logging.DEBUG)
-app = QApplication(sys.argv)
-widget = I4CheckMainWindow()
-widget.show()
-sys.exit(app.exec_())
+def main(argv=None):
+    logging.basicConfig(
+        level=logging.DEBUG if os.environ.get("I4CHECKLIST_DEBUG")
+        else logging.WARNING)
+    settings = QSettings("fionbio", "i4checklist")
+    settings.beginGroup("debug")
+    try:
+        if settings.value("profile", QVariant(False)).toBool():
+            profile.enabled = True
+    finally:
+        settings.endGroup()
+    app = QApplication(argv if argv is not None else sys.argv)
+    widget = I4CheckMainWindow()
+    widget.show()
+    return app.exec_()
+
+if __name__ == "__main__":
+    sys.exit(main())
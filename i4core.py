@@ -0,0 +1,1474 @@
+#!/usr/bin/env python
+# i4checklist core: the org checklist format, the journal and the list
+# operations. This module doesn't depend on Qt and can be used from
+# scripts and tests.
+from __future__ import with_statement
+import bisect
+import heapq
+import logging
+import mmap
+import re
+import struct
+import sys
+import os.path
+import threading
+import time
+from array import array
+from itertools import count, izip, islice
+
+log = logging.getLogger(__name__)
+
+SAMPLE_DATA = """* ALL
+  - [ ] item one
+  - [ ] item two
+  - [ ] item three
+  - [ ] item four
+** NEED
+   - [ ] item five
+   - [X] item six
+   - [X] item seven
+"""
+
+class ParseError(Exception):
+    def __init__(self, message, line_no=None):
+        if line_no is not None:
+            message = "line %d: %s" % (line_no, message)
+        super(ParseError, self).__init__(message)
+        self.line_no = line_no
+
+ALL_RE = re.compile(r"\*\s*ALL")
+NEED_RE = re.compile(r"\*\*\s*NEED")
+CHECK_LINE_RE = re.compile(r"\s*-\s*\[(.)\]\s*(.*?)\s*$")
+
+def decode_title(title, line_no=None):
+    try:
+        return title.decode("utf-8")
+    except UnicodeDecodeError, e:
+        raise ParseError("bad title %r: %s" % (title, e), line_no)
+
+def parse_check_line(line, line_no=None):
+    m = CHECK_LINE_RE.match(line)
+    if not m:
+        raise ParseError("expected check line, got %r" % line, line_no)
+    return bool(m.group(1).strip()), decode_title(m.group(2), line_no)
+
+NOT_NEEDED = 0
+NEED = 1
+CHECKED = 2
+
+DB_CACHE_BUDGET = 16 * 1024 * 1024
+# items per chunk handed over by DatabaseReader
+LOAD_CHUNK = 1000
+
+# Profiling. The hot paths count things and time themselves into
+# histograms when profile.enabled is true: with I4CHECKLIST_PROFILE set
+# in the environment, or when the application enables it. Otherwise
+# they only test profile.enabled.
+PROFILE_BUCKETS_MS = (0.1, 0.3, 1, 3, 10, 30, 100, 300, 1000)
+
+class Profile(object):
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        self.counts = {}
+        # name -> [count, total, max, bucket counts]
+        self.timings = {}
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def add_time(self, name, seconds):
+        timing = self.timings.get(name)
+        if timing is None:
+            timing = self.timings[name] = \
+                [0, 0.0, 0.0, [0] * (len(PROFILE_BUCKETS_MS) + 1)]
+        timing[0] += 1
+        timing[1] += seconds
+        timing[2] = max(timing[2], seconds)
+        timing[3][bisect.bisect_left(PROFILE_BUCKETS_MS,
+                                     seconds * 1000)] += 1
+
+    def timed(self, name):
+        # decorator timing the calls of a function as name
+        def decorate(f):
+            def timed_f(*args, **kw):
+                if not self.enabled:
+                    return f(*args, **kw)
+                start = time.time()
+                try:
+                    return f(*args, **kw)
+                finally:
+                    self.add_time(name, time.time() - start)
+            timed_f.__name__ = f.__name__
+            return timed_f
+        return decorate
+
+    def report(self):
+        lines = ["%-12s %7s %10s %8s %8s  %s" % (
+            "timing", "calls", "total ms", "mean ms", "max ms",
+            " ".join("<%g" % ms for ms in PROFILE_BUCKETS_MS) + " more")]
+        for name in sorted(self.timings):
+            n, total, longest, buckets = self.timings[name]
+            lines.append("%-12s %7d %10.1f %8.2f %8.1f  %s" % (
+                name, n, total * 1000, total * 1000 / n, longest * 1000,
+                " ".join(str(k) for k in buckets)))
+        if self.counts:
+            lines.append("")
+            lines.append("%-12s %7s" % ("counter", "count"))
+            for name in sorted(self.counts):
+                lines.append("%-12s %7d" % (name, self.counts[name]))
+        return "".join(line + "\n" for line in lines)
+
+profile = Profile(bool(os.environ.get("I4CHECKLIST_PROFILE")))
+
+def parse_data(s):
+    # s may be any iterable of lines, e.g. a file, which is read lazily
+    lines = izip(count(1), s)
+    for line_no, line in lines:
+        if not line.strip():
+            continue
+        if not ALL_RE.match(line):
+            raise ParseError("expected * ALL, got %r" % line, line_no)
+        break
+    need = False
+    for line_no, line in lines:
+        text = line.strip()
+        if text[:3] == "- [" and text[4:5] == "]":
+            # fast path for the usual "- [X] title" lines
+            checked, title = text[3].strip(), text[5:].lstrip()
+        elif not text:
+            continue
+        elif not need and NEED_RE.match(line):
+            need = True
+            continue
+        else:
+            m = CHECK_LINE_RE.match(line)
+            if m is None:
+                raise ParseError(
+                    "expected check line, got %r" % line, line_no)
+            checked, title = m.group(1).strip(), m.group(2)
+        title = decode_title(title, line_no)
+        if not need:
+            yield NOT_NEEDED, title
+        elif checked:
+            yield CHECKED, title
+        else:
+            yield NEED, title
+
+@profile.timed("serialize")
+def serialize_data(data, out):
+    not_needed = ["* ALL\n"]
+    need = ["** NEED\n"]
+    for state, title in data:
+        title = title.encode("utf-8")
+        if state == NOT_NEEDED:
+            not_needed.append("  - [ ] %s\n" % title)
+        elif state == CHECKED:
+            need.append("   - [X] %s\n" % title)
+        else:
+            need.append("   - [ ] %s\n" % title)
+    not_needed.extend(need)
+    out.write("".join(not_needed))
+
+JOURNAL_SUFFIX = ".journal"
+TEMP_SUFFIX = ".tmp"
+JOURNAL_COMPACT_SIZE = 64 * 1024
+JOURNAL_MAGIC = "i4journal"
+BINARY_SUFFIX = ".i4b"
+
+DB_DIR = "~/MyDocs/.i4checklist"
+
+def default_db_dir():
+    return os.path.expanduser(DB_DIR)
+
+def list_databases(db_dir):
+    return sorted(filename for filename in os.listdir(db_dir)
+                  if is_database_file(filename) and
+                  os.path.isfile(os.path.join(db_dir, filename)))
+
+def is_database_file(filename):
+    return not filename.startswith(".") and \
+        not filename.endswith(JOURNAL_SUFFIX) and \
+        not filename.endswith(BINARY_SUFFIX) and \
+        not filename.endswith(TEMP_SUFFIX)
+
+def file_signature(path):
+    # a replaced or externally edited file gets a different signature
+    try:
+        st = os.stat(path)
+    except OSError:
+        return "-"
+    return "%d:%d:%d" % (st.st_ino, st.st_size, int(st.st_mtime * 1000))
+
+def write_atomically(path, write):
+    # write to a temporary file first so that a crash never leaves
+    # a truncated file behind
+    tmp_path = path + TEMP_SUFFIX
+    with open(tmp_path, "wb") as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+
+def write_snapshot(path, data):
+    write_atomically(path, lambda f: serialize_data(data, f))
+
+# Journal records:
+#   ("+", state, title)  add an item
+#   ("-", state, title)  remove an item
+#   ("R", states)        make all the items with these states NOT_NEEDED
+def format_journal_record(record):
+    if record[0] == "R":
+        return "R %s\n" % "".join(str(state) for state in record[1])
+    op, state, title = record
+    return "%s %d %s\n" % (op, state, title.encode("utf-8"))
+
+def parse_journal(f):
+    for line in f:
+        if not line.endswith("\n"):
+            # a record that was cut short by a crash
+            break
+        op, arg = line[0], line[2:-1]
+        if op == "R":
+            yield op, frozenset(int(state) for state in arg)
+        elif op == "+" or op == "-":
+            yield op, int(arg[0]), arg[2:].decode("utf-8")
+        else:
+            raise ParseError("bad journal record %r" % line)
+
+def replay_journal(data, records, missing=None):
+    # Applies the records to data, a list of (state, title) items.
+    # The removals of the items that aren't there are skipped and, if
+    # missing is a list, added to it.
+    counts = {}
+    for item in data:
+        counts[item] = counts.get(item, 0) + 1
+    for record in records:
+        if record[0] == "R":
+            for (state, title), n in counts.items():
+                if state in record[1]:
+                    del counts[state, title]
+                    key = NOT_NEEDED, title
+                    counts[key] = counts.get(key, 0) + n
+            continue
+        op, state, title = record
+        key = state, title
+        if op == "+":
+            counts[key] = counts.get(key, 0) + 1
+        elif counts.get(key):
+            counts[key] -= 1
+        elif missing is not None:
+            missing.append(key)
+        else:
+            log.warning("replay_journal(): no item %r to remove", key)
+    data = []
+    for key in sorted(counts):
+        data.extend([key] * counts[key])
+    return data
+
+class Journal(object):
+    # Append-only log of the changes made to the database at path
+    # since its last snapshot. The log starts with the signature of
+    # the snapshot it applies to, so a log left over after the
+    # snapshot was replaced is ignored. Such a stale log is kept until
+    # the database is written again, see stale_records().
+    def __init__(self, path):
+        self.path = path
+        self.journal_path = path + JOURNAL_SUFFIX
+
+    def exists(self):
+        return os.path.exists(self.journal_path)
+
+    def size(self):
+        try:
+            return os.path.getsize(self.journal_path)
+        except OSError:
+            return 0
+
+    def read(self, data):
+        if not self.exists():
+            return data
+        with open(self.journal_path) as f:
+            header = f.readline().split()
+            if header == [JOURNAL_MAGIC, file_signature(self.path)]:
+                return replay_journal(data, parse_journal(f))
+        log.warning("Journal.read(): ignoring stale journal %s",
+                    self.journal_path)
+        return data
+
+    def stale(self):
+        if not self.exists():
+            return False
+        with open(self.journal_path) as f:
+            header = f.readline().split()
+        return header != [JOURNAL_MAGIC, file_signature(self.path)]
+
+    def stale_records(self):
+        # Returns the records of a journal left from another version of
+        # the database file, e.g. one written by another program. They
+        # are lost once the database is written.
+        if not self.exists():
+            return []
+        with open(self.journal_path) as f:
+            header = f.readline().split()
+            if header[:1] != [JOURNAL_MAGIC] or \
+                    header == [JOURNAL_MAGIC, file_signature(self.path)]:
+                return []
+            try:
+                return list(parse_journal(f))
+            except (ParseError, ValueError), e:
+                log.warning("Journal.stale_records(): %s: %s",
+                            self.journal_path, e)
+                return []
+
+    def append(self, records):
+        if not records:
+            return
+        if self.stale():
+            # the records wouldn't be read after the stale ones
+            log.warning("Journal.append(): replacing stale journal %s",
+                        self.journal_path)
+            self.remove()
+        chunks = []
+        if not self.exists():
+            chunks.append("%s %s\n" % (JOURNAL_MAGIC,
+                                       file_signature(self.path)))
+        chunks.extend(format_journal_record(r) for r in records)
+        with open(self.journal_path, "at") as f:
+            f.write("".join(chunks))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def compact(self, data):
+        write_snapshot(self.path, data)
+        self.remove()
+
+    def remove(self):
+        if self.exists():
+            os.unlink(self.journal_path)
+
+# The binary form of a database, kept next to it in path + BINARY_SUFFIX
+# so that it can be opened without parsing. It's made from the sorted
+# items and holds the signature of the database file it was made from,
+# so it's only used while that file stays the same. Layout:
+#   header (BINARY_HEADER)
+#   states, a byte per item, padded to 4 bytes
+#   offsets of the titles in the blob, n + 1 little endian uint32
+#   the blob of UTF-8 encoded titles, each followed by a newline so
+#   that all of them can be decoded at once
+BINARY_MAGIC = "i4binary"
+BINARY_VERSION = 2
+# magic, version, signature, blank title count, per state item counts
+BINARY_HEADER = struct.Struct("<8sI64sIIII")
+
+class MappedTitles(object):
+    # Read-only sequence of the titles of a mapped binary database.
+    # The titles are decoded when they're accessed, or all at once
+    # when they're iterated over.
+    def __init__(self, data, offsets, base, blank):
+        self._data = data
+        self._offsets = offsets
+        self._base = base
+        # the number of the titles that are empty or whitespace
+        self.blank = blank
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[k] for k in xrange(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("title index out of range")
+        start = self._base + self._offsets[i]
+        end = self._base + self._offsets[i + 1] - 1
+        return self._data[start:end].decode("utf-8")
+
+    def __iter__(self):
+        return iter(self.decode())
+
+    def decode(self):
+        # the list of all the titles
+        return self._data[self._base:].decode("utf-8").split(u"\n")[:-1]
+
+    def __contains__(self, title):
+        if not title.strip() and not self.blank:
+            return False
+        return title in self.decode()
+
+    def size(self):
+        return len(self._data)
+
+def write_binary(path, data):
+    # writes the binary form of the database at path, which must
+    # already contain the (sorted) items in data
+    states = array("B")
+    offsets = array("I", [0])
+    blobs = []
+    blank = pos = 0
+    for state, title in data:
+        states.append(state)
+        if not title.strip():
+            blank += 1
+        title = title.encode("utf-8") + "\n"
+        blobs.append(title)
+        pos += len(title)
+        offsets.append(pos)
+    if sys.byteorder != "little":
+        offsets.byteswap()
+    header = BINARY_HEADER.pack(
+        BINARY_MAGIC, BINARY_VERSION, file_signature(path), blank,
+        *count_states(states))
+    padding = "\0" * (-(len(header) + len(states)) % 4)
+    write_atomically(
+        path + BINARY_SUFFIX,
+        lambda f: f.write("".join([header, states.tostring(), padding,
+                                   offsets.tostring()] + blobs)))
+
+def read_binary(bin_path):
+    # Maps the binary database file. Returns the signature of the
+    # database file it was made from, the states array and the titles
+    # as a MappedTitles.
+    with open(bin_path, "rb") as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError), e:
+            raise ParseError("can't map %s: %s" % (bin_path, e))
+    if len(data) < BINARY_HEADER.size:
+        raise ParseError("truncated binary database")
+    header = BINARY_HEADER.unpack(data[:BINARY_HEADER.size])
+    magic, version, signature, blank = header[:4]
+    counts = list(header[4:])
+    if magic != BINARY_MAGIC or version != BINARY_VERSION:
+        raise ParseError("not a binary database")
+    n = sum(counts)
+    start = BINARY_HEADER.size
+    offsets_start = start + n + (-(start + n) % 4)
+    base = offsets_start + 4 * (n + 1)
+    if len(data) < base:
+        raise ParseError("truncated binary database")
+    states = array("B", data[start:start + n])
+    offsets = array("I", data[offsets_start:base])
+    if sys.byteorder != "little":
+        offsets.byteswap()
+    if count_states(states) != counts or base + offsets[-1] != len(data):
+        raise ParseError("corrupt binary database")
+    return signature.rstrip("\0"), states, \
+        MappedTitles(data, offsets, base, blank)
+
+def open_binary(path):
+    # Returns the states and titles of the database at path from its
+    # binary form, or None if there's none or it's out of date.
+    bin_path = path + BINARY_SUFFIX
+    if not os.path.exists(bin_path):
+        return None
+    try:
+        signature, states, titles = read_binary(bin_path)
+    except (ParseError, EnvironmentError), e:
+        log.warning("open_binary(): %s: %s", bin_path, e)
+        signature = None
+    if signature is not None and signature == file_signature(path):
+        return states, titles
+    log.debug("open_binary(): removing stale %s", bin_path)
+    try:
+        os.unlink(bin_path)
+    except OSError:
+        pass
+    return None
+
+def convert(src_path, dst_path):
+    # Converts between the org and binary forms of a database; the
+    # direction is chosen by BINARY_SUFFIX. The binary form needs the
+    # org file to be next to it, so converting to binary writes
+    # dst_path and dst_path + BINARY_SUFFIX.
+    if src_path.endswith(BINARY_SUFFIX):
+        signature, states, titles = read_binary(src_path)
+        write_snapshot(dst_path, izip(states, titles))
+        return
+    if dst_path.endswith(BINARY_SUFFIX):
+        dst_path = dst_path[:-len(BINARY_SUFFIX)]
+    with open(src_path) as f:
+        data = sorted(parse_data(f))
+    if os.path.abspath(src_path) != os.path.abspath(dst_path):
+        write_snapshot(dst_path, data)
+    write_binary(dst_path, data)
+
+# items is usually the lazy parse_data(), so this times the parsing
+@profile.timed("parse")
+def read_columns(items, states, titles):
+    # Appends (state, title) items to the states array and the titles
+    # list. Returns true if the items are sorted, which is the case
+    # for the files written by i4checklist.
+    ordered = True
+    last = NOT_NEEDED, u""
+    add_state, add_title = states.append, titles.append
+    for item in items:
+        if ordered and item < last:
+            ordered = False
+        last = item
+        add_state(item[0])
+        add_title(item[1])
+    return ordered
+
+def count_states(states):
+    # returns [NOT_NEEDED, NEED, CHECKED] counts for a sorted
+    # states array
+    need = bisect.bisect_left(states, NEED)
+    checked = bisect.bisect_left(states, CHECKED, need)
+    return [need, checked - need, len(states) - checked]
+
+def columns(rows):
+    # splits a list of (state, title) pairs into a states array
+    # and a list of titles
+    states, titles = rows and zip(*rows) or ((), ())
+    return array("B", states), list(titles)
+
+# The item list operations. The items are kept in a states array and
+# a list of titles sorted by (state, title), and the items are referred
+# to by their indices in these.
+
+CHECKOUT_STATES = frozenset([CHECKED])
+RESET_STATES = frozenset([NEED, CHECKED])
+
+def find_position(states, titles, state, title):
+    # (state, title) of each item is its sort key, so the position is
+    # found by bisecting the states and then the titles within the
+    # state's range
+    lo = bisect.bisect_left(states, state)
+    hi = bisect.bisect_right(states, state, lo)
+    return bisect.bisect_left(titles, title, lo, hi)
+
+def state_items(states, item_states):
+    # returns the sorted indices of the items in any of item_states
+    items = []
+    for state in sorted(item_states):
+        lo = bisect.bisect_left(states, state)
+        items.extend(xrange(lo, bisect.bisect_right(states, state, lo)))
+    return items
+
+def empty_items(titles):
+    return [i for i, title in enumerate(titles) if not title.strip()]
+
+def change_states(states, titles, items, state):
+    # Returns new states and titles with the items (sorted indices)
+    # set to state. The changed items form sorted runs, so re-sorting
+    # is mostly a merge.
+    rows = zip(states, titles)
+    for i in items:
+        rows[i] = state, rows[i][1]
+    rows.sort()
+    return columns(rows)
+
+def diff_items(states, titles, rows):
+    # Compares the items with rows, a sorted list of (state, title)
+    # pairs. Returns the sorted indices of the items that aren't in rows
+    # and the rows that aren't among the items.
+    removed, added = [], []
+    i, n = 0, len(titles)
+    for row in rows:
+        while i < n and (states[i], titles[i]) < row:
+            removed.append(i)
+            i += 1
+        if i < n and (states[i], titles[i]) == row:
+            i += 1
+        else:
+            added.append(row)
+    removed.extend(xrange(i, n))
+    return removed, added
+
+@profile.timed("cleanup_items")
+def cleanup_items(states, titles, reset_states=frozenset()):
+    # What cleanup/checkout/reset do to the items: the items with
+    # empty titles are removed and the ones in reset_states become
+    # NOT_NEEDED. Returns new states and titles.
+    empty = empty_items(titles)
+    if empty:
+        rows = zip(states, titles)
+        for i in reversed(empty):
+            del rows[i]
+        states, titles = columns(rows)
+    return change_states(
+        states, titles,
+        state_items(states, reset_states - frozenset([NOT_NEEDED])),
+        NOT_NEEDED)
+
+# Title search. A query is split into words and matches the titles
+# that contain all of them, ignoring case. The words shorter than
+# SEARCH_GRAM characters only match at the start of the title's words.
+
+SEARCH_GRAM = 3
+
+def search_words(text):
+    return text.lower().split()
+
+def search_keys(word):
+    # the trigrams of the word and its one and two character prefixes
+    keys = set(word[k:k + SEARCH_GRAM]
+               for k in xrange(len(word) - SEARCH_GRAM + 1))
+    keys.update(word[:n] for n in xrange(1, SEARCH_GRAM))
+    return keys
+
+def word_matches(word, query_word):
+    if len(query_word) < SEARCH_GRAM:
+        return word.startswith(query_word)
+    return query_word in word
+
+class TitleIndex(object):
+    # Maps the words of the titles to the sets of titles having them
+    # and the search keys to the sets of words having them. The query
+    # words contain no spaces, so each of them has to be found within
+    # a single word of the title, and a search only looks at the words
+    # sharing the query word's keys. The titles are reference counted
+    # as there may be several items with the same title.
+    @profile.timed("index")
+    def __init__(self, titles=()):
+        self._keys = {}
+        self._words = {}
+        self._refs = {}
+        for title in titles:
+            self.add(title)
+
+    def add(self, title):
+        n = self._refs.get(title, 0)
+        self._refs[title] = n + 1
+        if n:
+            return
+        for word in search_words(title):
+            titles = self._words.get(word)
+            if titles is None:
+                titles = self._words[word] = set()
+                for key in search_keys(word):
+                    self._keys.setdefault(key, set()).add(word)
+            titles.add(title)
+
+    def remove(self, title):
+        n = self._refs.pop(title)
+        if n > 1:
+            self._refs[title] = n - 1
+            return
+        for word in search_words(title):
+            titles = self._words.get(word)
+            if titles is None:
+                # a repeated word
+                continue
+            titles.discard(title)
+            if titles:
+                continue
+            del self._words[word]
+            for key in search_keys(word):
+                words = self._keys[key]
+                words.discard(word)
+                if not words:
+                    del self._keys[key]
+
+    def find_words(self, query_word):
+        if len(query_word) < SEARCH_GRAM:
+            return self._keys.get(query_word, set())
+        postings = sorted(
+            (self._keys.get(query_word[k:k + SEARCH_GRAM], ())
+             for k in xrange(len(query_word) - SEARCH_GRAM + 1)), key=len)
+        return [word for word in postings[0]
+                if word_matches(word, query_word)]
+
+    @profile.timed("search")
+    def search(self, query):
+        # returns the set of the matching titles
+        matches = []
+        for query_word in search_words(query):
+            words = self.find_words(query_word)
+            matches.append((sum(len(self._words[word]) for word in words),
+                            query_word, words))
+        if not matches:
+            return set(self._refs)
+        # start with the most selective word; once there are only a few
+        # titles left, it's cheaper to check them than to collect all
+        # the titles having the other words, even though checking a
+        # title is much slower than adding it to a set
+        matches.sort()
+        found = set()
+        for word in matches[0][2]:
+            found.update(self._words[word])
+        for n, query_word, words in matches[1:]:
+            if len(found) * 16 < n:
+                found = set(
+                    title for title in found
+                    if [word for word in search_words(title)
+                        if word_matches(word, query_word)])
+            else:
+                titles = set()
+                for word in words:
+                    titles.update(self._words[word])
+                found &= titles
+            if not found:
+                break
+        return found
+
+# Without an index, the titles are searched through their keys: the
+# words of the title separated by single spaces with one in front. A
+# query word of SEARCH_GRAM characters or more matches the title if
+# it's in the key, a shorter one if it follows a space in the key.
+
+def search_key(title):
+    return u" " + u" ".join(search_words(title))
+
+def search_patterns(query):
+    return [word if len(word) >= SEARCH_GRAM else u" " + word
+            for word in search_words(query)]
+
+def scan_titles(titles, query, keys, start=0):
+    # Returns the indices of the titles starting from start that match
+    # the query. keys caches the search_key() of the titles.
+    try:
+        title_keys = map(keys.__getitem__, titles)
+    except KeyError:
+        for title in titles:
+            if title not in keys:
+                keys[title] = search_key(title)
+        title_keys = map(keys.__getitem__, titles)
+    items = xrange(start, len(titles))
+    for pattern in sorted(search_patterns(query), key=len, reverse=True):
+        items = [i for i in items if pattern in title_keys[i]]
+    return list(items)
+
+class IndexBuilder(object):
+    # Builds the TitleIndex of the titles in a background thread. The
+    # titles mustn't change while it's being built. Before that, the
+    # search_key() of the titles is put in keys for scan_titles() to
+    # use until the index is ready. As the threads share the
+    # interpreter, the building is paused while paused is set, e.g.
+    # while the titles are scanned.
+    def __init__(self, titles, keys):
+        self.index = None
+        self.paused = False
+        self._titles = titles
+        self._keys = keys
+        self._cancelled = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.start()
+
+    def done(self):
+        return not self._thread.isAlive()
+
+    def cancel(self):
+        self._cancelled = True
+        self._thread.join()
+
+    def _run(self):
+        keys = self._keys
+        for k, title in enumerate(self._titles):
+            if k % 100 == 0:
+                self._wait()
+            if self._cancelled:
+                return
+            if title not in keys:
+                keys[title] = search_key(title)
+        index = TitleIndex()
+        for k, title in enumerate(self._titles):
+            if k % 100 == 0:
+                self._wait()
+            if self._cancelled:
+                return
+            index.add(title)
+        self.index = index
+
+    def _wait(self):
+        while self.paused and not self._cancelled:
+            time.sleep(0.001)
+
+@profile.timed("filter")
+def filter_items(states, titles, found, start=0):
+    # Returns the sorted indices of the items starting from start whose
+    # titles are in the found set. Looking up a title by bisection
+    # takes as long as checking a hundred or two items, so the items
+    # are scanned unless only a few titles were found.
+    n = len(titles)
+    if len(found) * 128 > n - start:
+        return [i for i in xrange(start, n) if titles[i] in found]
+    items = []
+    for title in found:
+        for state in (NOT_NEEDED, NEED, CHECKED):
+            i = find_position(states, titles, state, title)
+            while i < n and states[i] == state and titles[i] == title:
+                if i >= start:
+                    items.append(i)
+                i += 1
+    items.sort()
+    return items
+
+def database_signature(path):
+    return file_signature(path), file_signature(path + JOURNAL_SUFFIX)
+
+def estimate_size(states, titles):
+    if isinstance(titles, MappedTitles):
+        return len(states) + titles.size()
+    return len(states) + 4 * len(titles) + \
+        sum(sys.getsizeof(title) for title in titles)
+
+class DatabaseCache(object):
+    # LRU cache of the parsed databases that aren't currently loaded,
+    # limited to budget bytes. An entry is only used if the database
+    # and its journal didn't change on disk since they were read or
+    # since we last wrote them (see refresh()).
+    def __init__(self, budget=DB_CACHE_BUDGET):
+        self.budget = budget
+        self._lock = threading.Lock()
+        self._entries = {} # path -> [states, titles, signature, size]
+        self._lru = [] # least recently used first
+        self._size = 0
+
+    def put(self, path, states, titles, signature):
+        # signature is the database_signature() of the files the items
+        # were read from or written to
+        size = estimate_size(states, titles)
+        with self._lock:
+            self._discard(path)
+            if size > self.budget:
+                return
+            self._entries[path] = [states, titles, signature, size]
+            self._lru.append(path)
+            self._size += size
+            while self._size > self.budget:
+                self._discard(self._lru[0])
+
+    def take(self, path):
+        # the entry is removed from the cache as its arrays are going
+        # to be modified by the model
+        with self._lock:
+            entry = self._entries.get(path)
+            self._discard(path)
+        if entry is None or entry[2] != database_signature(path):
+            return None
+        return entry[0], entry[1]
+
+    def refresh(self, path):
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None:
+                entry[2] = database_signature(path)
+
+    def discard(self, path):
+        with self._lock:
+            self._discard(path)
+
+    def _discard(self, path):
+        entry = self._entries.pop(path, None)
+        if entry is not None:
+            self._lru.remove(path)
+            self._size -= entry[3]
+
+class DatabaseWriter(object):
+    # Writes the databases in a background thread. There's at most one
+    # pending job per database, so that rapid saves coalesce: a new
+    # snapshot supersedes anything queued for the database before it,
+    # journal records are appended to the ones already queued.
+    def __init__(self, written=None, binary=False):
+        # written(path, error) is called from the writer thread after
+        # the database at path was written; error is None or the
+        # message of the failure
+        self.written = written
+        # whether to write the binary form along with the snapshots
+        self.binary = binary
+        self._cond = threading.Condition()
+        self._jobs = [] # [path, records, data or None]
+        self._thread = None
+        self._current = None
+
+    def submit(self, path, records, data=None):
+        with self._cond:
+            for job in self._jobs:
+                if job[0] == path:
+                    if data is not None:
+                        job[1:] = [list(records), data]
+                    else:
+                        job[1].extend(records)
+                    break
+            else:
+                self._jobs.append([path, list(records), data])
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.start()
+
+    def pending(self, path):
+        # whether the database at path is still to be written
+        with self._cond:
+            return path == self._current or \
+                path in [job[0] for job in self._jobs]
+
+    def flush(self, path=None):
+        # waits until the database at path, or all of them,
+        # are written
+        with self._cond:
+            while self._thread is not None and \
+                    (path is None or path == self._current or
+                     path in [job[0] for job in self._jobs]):
+                self._cond.wait()
+
+    def _run(self):
+        # the thread exits once there's nothing left to write
+        while True:
+            with self._cond:
+                self._current = None
+                self._cond.notifyAll()
+                if not self._jobs:
+                    self._thread = None
+                    return
+                path, records, data = self._jobs.pop(0)
+                self._current = path
+            start = time.time()
+            try:
+                journal = Journal(path)
+                if data is not None:
+                    journal.compact(data)
+                journal.append(records)
+                if data is not None and self.binary:
+                    write_binary(path, data)
+            except (IOError, OSError), e:
+                log.error("DatabaseWriter: failed to write %s: %s",
+                          path, e)
+                if self.written is not None:
+                    self.written(path, str(e))
+            else:
+                if profile.enabled:
+                    profile.add_time("write", time.time() - start)
+                if self.written is not None:
+                    self.written(path, None)
+
+class DatabaseReader(object):
+    # Reads the database at path in a background thread. The items are
+    # handed over by take() in chunks of LOAD_CHUNK as they're parsed,
+    # as long as they come sorted, which they do in the files written
+    # by i4checklist. When the reading is done, rows is None if the
+    # chunks were all the items, otherwise the sorted (states, titles)
+    # of all of them: the file wasn't sorted or it had a journal.
+    # error is set if the reading failed part way.
+    def __init__(self, path):
+        self.path = path
+        self.rows = None
+        self.error = None
+        self._lock = threading.Lock()
+        self._chunks = []
+        self._done = False
+        self._cancelled = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.start()
+
+    def take(self):
+        # returns the chunks parsed since the last call and whether
+        # the reading is done
+        with self._lock:
+            chunks, self._chunks = self._chunks, []
+            return chunks, self._done
+
+    def wait(self):
+        self._thread.join()
+
+    def cancel(self):
+        self._cancelled = True
+        self._thread.join()
+
+    def _run(self):
+        states, titles = array("B"), []
+        ordered = True
+        chunk = None
+        try:
+            try:
+                with open(self.path) as f:
+                    items = parse_data(f)
+                    while not self._cancelled:
+                        chunk = array("B"), []
+                        chunk_ordered = read_columns(
+                            islice(items, LOAD_CHUNK), *chunk)
+                        if not chunk[1]:
+                            break
+                        if ordered and titles and \
+                                (chunk[0][0], chunk[1][0]) < \
+                                (states[-1], titles[-1]):
+                            chunk_ordered = False
+                        states.extend(chunk[0])
+                        titles.extend(chunk[1])
+                        if ordered and chunk_ordered:
+                            with self._lock:
+                                self._chunks.append(chunk)
+                        ordered = ordered and chunk_ordered
+                    chunk = None
+                journal = Journal(self.path)
+                if journal.exists() and not self._cancelled:
+                    rows = journal.read(zip(states, titles))
+                    states, titles = columns(rows)
+                    ordered = False
+            except (ParseError, ValueError, EnvironmentError), e:
+                self.error = str(e)
+                ordered = False
+                if chunk is not None:
+                    # keep the items of the chunk parsed before the error
+                    states.extend(chunk[0])
+                    titles.extend(chunk[1])
+            if not ordered and not self._cancelled:
+                self.rows = columns(sorted(izip(states, titles)))
+        finally:
+            with self._lock:
+                self._done = True
+
+# What's needed in all the databases
+
+SUMMARY_FILE = ".i4summary"
+SUMMARY_MAGIC = "i4summary"
+
+def read_database(path):
+    # the sorted items of the database at path including its journal
+    rows = []
+    if os.path.exists(path):
+        with open(path) as f:
+            rows = list(parse_data(f))
+    return sorted(Journal(path).read(rows))
+
+class NeedSummaries(object):
+    # The NEED and CHECKED items of each database in db_dir, kept with
+    # the signature of the database they were read from and saved to
+    # SUMMARY_FILE there. Only the databases that changed since are
+    # read again.
+    def __init__(self, db_dir):
+        self.db_dir = db_dir
+        self.path = os.path.join(db_dir, SUMMARY_FILE)
+        self._entries = None # name -> [signature, sorted rows]
+        self._changed = False
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        self._entries = {}
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                if f.readline() != SUMMARY_MAGIC + "\n":
+                    return
+                rows = None
+                for line in f:
+                    if not line.endswith("\n"):
+                        break
+                    if line.startswith("D "):
+                        db_signature, journal_signature, name = \
+                            line[2:-1].split(" ", 2)
+                        rows = []
+                        self._entries[name] = \
+                            [(db_signature, journal_signature), rows]
+                    elif rows is not None:
+                        rows.append((int(line[0]), line[2:-1].decode("utf-8")))
+        except (EnvironmentError, ValueError), e:
+            log.warning("NeedSummaries: %s: %s", self.path, e)
+            self._entries = {}
+
+    def get(self, names):
+        # Returns [(name, rows)] for the databases with these names.
+        # rows is None for the databases that failed to load.
+        self._load()
+        result = []
+        for name in names:
+            path = os.path.join(self.db_dir, name)
+            signature = database_signature(path)
+            entry = self._entries.get(name)
+            if entry is None or entry[0] != signature:
+                try:
+                    rows = [row for row in read_database(path)
+                            if row[0] != NOT_NEEDED]
+                except (ParseError, ValueError, EnvironmentError), e:
+                    log.error("NeedSummaries.get(): %s: %s", path, e)
+                    result.append((name, None))
+                    continue
+                entry = self._entries[name] = [signature, rows]
+                self._changed = True
+            result.append((name, entry[1]))
+        for name in set(self._entries) - set(names):
+            del self._entries[name]
+            self._changed = True
+        return result
+
+    def put(self, name, rows, signature):
+        self._load()
+        self._entries[name] = [signature, rows]
+        self._changed = True
+
+    def is_current(self, name):
+        # whether the database didn't change since its summary was read
+        self._load()
+        entry = self._entries.get(name)
+        return entry is not None and \
+            entry[0] == database_signature(os.path.join(self.db_dir, name))
+
+    def change(self, name, state, title, new_state, signature):
+        # the item's state was changed in the database, which now has
+        # the signature
+        self._load()
+        entry = self._entries.get(name)
+        if entry is None:
+            return
+        rows = entry[1]
+        i = bisect.bisect_left(rows, (state, title))
+        if i < len(rows) and rows[i] == (state, title):
+            del rows[i]
+        if new_state != NOT_NEEDED:
+            bisect.insort(rows, (new_state, title))
+        entry[0] = signature
+        self._changed = True
+
+    def save(self):
+        if not self._changed:
+            return
+        def write(f):
+            chunks = [SUMMARY_MAGIC + "\n"]
+            for name, (signature, rows) in sorted(self._entries.iteritems()):
+                chunks.append("D %s %s %s\n" % (signature + (name,)))
+                chunks.extend("%d %s\n" % (state, title.encode("utf-8"))
+                              for state, title in rows)
+            f.write("".join(chunks))
+        try:
+            write_atomically(self.path, write)
+        except EnvironmentError, e:
+            log.error("NeedSummaries.save(): %s: %s", self.path, e)
+        else:
+            self._changed = False
+
+# The history of the titles, for completing the titles being typed.
+# Each line of HISTORY_FILE says that a title was used weight times on
+# a day (counted from the epoch):
+#   <day> <weight> <title>
+# A title's score is the sum of its weights, each halved every
+# HISTORY_HALF_LIFE days, so the titles used often and lately come
+# first. New uses are appended to the file, which is rewritten with a
+# line per title once it gets too long.
+
+HISTORY_FILE = ".i4history"
+HISTORY_HALF_LIFE = 30.0
+HISTORY_COMPACT_LINES = 1000
+HISTORY_SUGGESTIONS = 8
+
+def today():
+    return int(time.time() // 86400)
+
+def history_decay(days):
+    return 0.5 ** (days / HISTORY_HALF_LIFE)
+
+def merge_uses(uses):
+    # Turns a list of ((title.lower(), title), weight, day) uses into
+    # the sorted keys with their scores as of the days they were last
+    # used. Sorts the list.
+    uses.sort()
+    keys, scores, days = [], array("d"), array("l")
+    for key, weight, day in uses:
+        if keys and keys[-1] == key:
+            last = max(day, days[-1])
+            scores[-1] = scores[-1] * history_decay(last - days[-1]) + \
+                weight * history_decay(last - day)
+            days[-1] = last
+        else:
+            keys.append(key)
+            scores.append(weight)
+            days.append(day)
+    return keys, scores, days
+
+class TitleHistory(object):
+    # The titles are kept sorted by (title.lower(), title) along with
+    # their scores as of the day they were last used, so the titles
+    # starting with what's typed are a range found by bisection. A
+    # short prefix matches a large part of the titles, which are then
+    # looked up in the order of their scores instead. The history
+    # starts with the titles of all the databases in db_dir.
+    #
+    # Reading the history, and the databases the first time, takes a
+    # while, so it's done in a background thread, which also records
+    # the uses. suggest() has nothing to suggest until the history is
+    # loaded.
+    def __init__(self, db_dir):
+        self.db_dir = db_dir
+        self.path = os.path.join(db_dir, HISTORY_FILE)
+        self._lock = threading.Lock()
+        self._keys = None # set once loaded
+        self._scores = array("d")
+        self._days = array("l")
+        self._lines = 0
+        # (day, keys in the order of their scores on the day)
+        self._ranked = None
+        # [(day, titles)] used and not recorded yet
+        self._pending = []
+        self._thread = None
+
+    def _start(self):
+        # called with _lock held
+        if self._thread is None and (self._keys is None or self._pending):
+            self._thread = threading.Thread(target=self._run)
+            self._thread.start()
+
+    def load(self):
+        # starts loading the history in the background
+        with self._lock:
+            self._start()
+
+    def flush(self):
+        # waits until the history is loaded and the uses are written
+        while True:
+            with self._lock:
+                thread = self._thread
+            if thread is None:
+                return
+            thread.join()
+
+    def use(self, titles):
+        # the titles were put on a list today
+        titles = [title.strip() for title in titles if title.strip()]
+        if not titles:
+            return
+        with self._lock:
+            self._pending.append((today(), titles))
+            self._start()
+
+    def _run(self):
+        # the thread exits once there's nothing left to record
+        if self._keys is None:
+            keys, scores, days, lines = self._read()
+            with self._lock:
+                self._keys, self._scores, self._days = keys, scores, days
+                self._lines = lines
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._thread = None
+                    return
+                pending, self._pending = self._pending, []
+                lines = []
+                for day, titles in pending:
+                    for title in titles:
+                        self._add(title, 1, day)
+                        lines.append("%d 1 %s\n" % (day,
+                                                     title.encode("utf-8")))
+                if self._lines + len(lines) > \
+                        2 * len(self._keys) + HISTORY_COMPACT_LINES:
+                    lines = None
+                    rows = zip(self._keys, self._scores, self._days)
+            if lines is None:
+                self._write(rows)
+            else:
+                self._append(lines)
+
+    def _read(self):
+        # returns the keys, scores, days and number of lines of the
+        # history file, or of the databases if there's none yet
+        if not os.path.exists(self.path):
+            return self._seed()
+        uses = []
+        lines = 0
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    if not line.endswith("\n"):
+                        break
+                    day, weight, title = line[:-1].split(" ", 2)
+                    title = title.decode("utf-8")
+                    uses.append(((title.lower(), title), float(weight),
+                                 int(day)))
+                    lines += 1
+        except (EnvironmentError, ValueError), e:
+            log.warning("TitleHistory: %s: %s", self.path, e)
+        return merge_uses(uses) + (lines,)
+
+    def _seed(self):
+        day = today()
+        uses = []
+        for name in list_databases(self.db_dir):
+            try:
+                rows = read_database(os.path.join(self.db_dir, name))
+            except (ParseError, ValueError, EnvironmentError), e:
+                log.warning("TitleHistory: %s: %s", name, e)
+                continue
+            uses.extend(((title.lower(), title),
+                         0 if state == NOT_NEEDED else 1, day)
+                        for state, title in rows if title)
+        keys, scores, days = merge_uses(uses)
+        lines = self._write(zip(keys, scores, days))
+        return keys, scores, days, lines
+
+    def _add(self, title, weight, day):
+        self._ranked = None
+        key = title.lower(), title
+        i = bisect.bisect_left(self._keys, key)
+        if i == len(self._keys) or self._keys[i] != key:
+            self._keys.insert(i, key)
+            self._scores.insert(i, weight)
+            self._days.insert(i, day)
+            return
+        last = max(day, self._days[i])
+        self._scores[i] = self._scores[i] * \
+            history_decay(last - self._days[i]) + \
+            weight * history_decay(last - day)
+        self._days[i] = last
+
+    def _write(self, rows):
+        # rewrites the file with the (key, score, day) rows; returns the
+        # number of lines in it
+        def write(f):
+            f.write("".join("%d %.6g %s\n" % (day, score,
+                                              title.encode("utf-8"))
+                            for (key, title), score, day in rows))
+        try:
+            write_atomically(self.path, write)
+        except EnvironmentError, e:
+            log.error("TitleHistory: failed to write %s: %s", self.path, e)
+            return 0
+        with self._lock:
+            self._lines = len(rows)
+        return len(rows)
+
+    def _append(self, lines):
+        try:
+            with open(self.path, "a") as f:
+                f.write("".join(lines))
+        except EnvironmentError, e:
+            log.error("TitleHistory: failed to write %s: %s", self.path, e)
+        else:
+            with self._lock:
+                self._lines += len(lines)
+
+    @profile.timed("suggest")
+    def suggest(self, text, limit=HISTORY_SUGGESTIONS):
+        # the best scoring titles starting with text, ignoring case
+        prefix = text.lstrip().lower()
+        if not prefix:
+            return []
+        with self._lock:
+            if self._keys is None:
+                self._start()
+                return []
+            lo = bisect.bisect_left(self._keys, (prefix,))
+            hi = bisect.bisect_left(self._keys, (prefix + u"\uffff",), lo)
+            if (hi - lo) * (hi - lo) > limit * len(self._keys):
+                # about limit * len / (hi - lo) titles to look at
+                titles = []
+                for key, title in self._ranked_keys():
+                    if key.startswith(prefix):
+                        titles.append(title)
+                        if len(titles) == limit:
+                            break
+                return titles
+            day, scores, days = today(), self._scores, self._days
+            best = heapq.nlargest(
+                limit, xrange(lo, hi),
+                key=lambda i: scores[i] * history_decay(day - days[i]))
+            return [self._keys[i][1] for i in best]
+
+    def _ranked_keys(self):
+        day = today()
+        if self._ranked is None or self._ranked[0] != day:
+            scores, days = self._scores, self._days
+            order = sorted(
+                xrange(len(self._keys)),
+                key=lambda i: -scores[i] * history_decay(day - days[i]))
+            self._ranked = day, [self._keys[i] for i in order]
+        return self._ranked[1]
+
+def test_it():
+    from cStringIO import StringIO
+    parsed = list(parse_data(StringIO(SAMPLE_DATA)))
+    print "PARSED:\n%r\n" % parsed
+    out = StringIO()
+    serialize_data(parsed, out)
+    serialized = out.getvalue()
+    print "SERIALIZED:\n%s---" % serialized
+    assert SAMPLE_DATA == serialized
+
+def test_replay():
+    from cStringIO import StringIO
+    data = sorted(parse_data(StringIO(SAMPLE_DATA)))
+    records = [("+", NEED, u"milk"), ("-", NOT_NEEDED, u"item one"),
+               ("-", NEED, u"item one"), ("+", NEED, u"\u043c\u043e\u043b"),
+               ("R", frozenset([CHECKED])), ("+", CHECKED, u"item one")]
+    missing = []
+    replayed = replay_journal(data, records, missing)
+    print "REPLAYED:\n%r\n" % replayed
+    assert missing == [(NEED, u"item one")]
+    assert replayed == sorted(
+        [(NOT_NEEDED if state == CHECKED else state, title)
+         for state, title in data if title != u"item one"] +
+        [(NEED, u"milk"), (NEED, u"\u043c\u043e\u043b"),
+         (CHECKED, u"item one")])
+    text = "".join(format_journal_record(record) for record in records)
+    assert list(parse_journal(StringIO(text))) == records
+    # a record cut short by a crash is dropped
+    assert list(parse_journal(StringIO(text + "+ 1 half"))) == records
+
+def test_journal():
+    from cStringIO import StringIO
+    import shutil
+    import tempfile
+    db_dir = tempfile.mkdtemp(prefix="i4core")
+    try:
+        path = os.path.join(db_dir, "default")
+        data = sorted(parse_data(StringIO(SAMPLE_DATA)))
+        write_snapshot(path, data)
+        records = [("+", NEED, u"milk"), ("-", CHECKED, u"item six"),
+                   ("R", frozenset([CHECKED]))]
+        journal = Journal(path)
+        journal.append(records[:2])
+        journal.append(records[2:])
+        assert not journal.stale()
+        assert read_database(path) == replay_journal(data, records)
+        # the database replaced behind the journal's back
+        write_snapshot(path, data[1:])
+        assert journal.stale()
+        assert read_database(path) == data[1:]
+        assert journal.exists() and journal.stale_records() == records
+        # a new journal replaces the stale one
+        journal.append([("+", NEED, u"eggs")])
+        assert not journal.stale() and journal.stale_records() == []
+        assert read_database(path) == sorted(data[1:] + [(NEED, u"eggs")])
+        journal.compact(read_database(path))
+        assert not journal.exists()
+        assert read_database(path) == sorted(data[1:] + [(NEED, u"eggs")])
+    finally:
+        shutil.rmtree(db_dir)
+
+def test_binary():
+    from cStringIO import StringIO
+    import shutil
+    import tempfile
+    db_dir = tempfile.mkdtemp(prefix="i4core")
+    try:
+        path = os.path.join(db_dir, "default")
+        data = sorted(list(parse_data(StringIO(SAMPLE_DATA))) +
+                      [(NOT_NEEDED, u""), (NEED, u"\u306d\u304e")])
+        write_snapshot(path, data)
+        write_binary(path, data)
+        signature, states, titles = read_binary(path + BINARY_SUFFIX)
+        assert signature == file_signature(path)
+        assert zip(states, titles) == data and list(titles) == \
+            [title for state, title in data]
+        assert titles[-1] == data[-1][1] and titles[1:3] == \
+            [title for state, title in data[1:3]]
+        assert u"" in titles and titles.blank == 1
+        assert open_binary(path) is not None
+        other = os.path.join(db_dir, "other")
+        convert(path + BINARY_SUFFIX, other)
+        assert read_database(other) == data
+        convert(other, other + BINARY_SUFFIX)
+        assert zip(*read_binary(other + BINARY_SUFFIX)[1:]) == data
+        # the binary form goes stale with the database
+        write_snapshot(path, data[1:])
+        assert open_binary(path) is None
+        assert not os.path.exists(path + BINARY_SUFFIX)
+    finally:
+        shutil.rmtree(db_dir)
+
+# python i4core.py runs the tests, python i4core.py convert SRC DST
+# converts a database between the org and binary forms (see convert())
+if __name__ == "__main__":
+    logging.basicConfig()
+    if len(sys.argv) == 4 and sys.argv[1] == "convert":
+        convert(sys.argv[2], sys.argv[3])
+    else:
+        test_it()
+        test_replay()
+        test_journal()
+        test_binary()